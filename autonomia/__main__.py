@@ -14,6 +14,8 @@ import traceback
 from gui import Display
 from workout import workout_main, viewer_main
 from battery import battery_main
+from store import import_main
+from export import export_main, parse_resolution, DEFAULT_RESOLUTION
 from metronome_test import metronome_test_main
 import metronome
 import bluetooth
@@ -34,6 +36,19 @@ if __name__ == "__main__":
         action="store_true",
         help="open the log viewer")
 
+    mutually_exclusive.add_argument(
+        "--export",
+        action="store",
+        type=pathlib.Path,
+        help="render the log viewer's graphs of every log to images in this directory")
+
+    parser.add_argument(
+        "--resolution",
+        action="store",
+        type=parse_resolution,
+        default=DEFAULT_RESOLUTION,
+        help="size of the exported images, such as 1920x1080")
+
     parser.add_argument(
         "--bpm_debug",
         action="store_true",
@@ -56,6 +71,34 @@ if __name__ == "__main__":
         action="store_true",
         help="plot bpm on a global scale")
 
+    parser.add_argument(
+        "--frame_stats",
+        action="store_true",
+        help="print the log viewer's frame rate and cpu use")
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="time each frame of the workout and graph it on screen, F3 toggles this while running")
+
+    parser.add_argument(
+        "--store",
+        action="store",
+        type=pathlib.Path,
+        default=None,
+        help="sqlite database of imported logs for the log viewer to read from")
+
+    parser.add_argument(
+        "--import_logs",
+        action="store_true",
+        help="import the workout logs into the --store database")
+
+    parser.add_argument(
+        "--benchmark",
+        action="store",
+        default=None,
+        help="run one of the performance benchmarks: backends, derive, hrm, ingest, ipc or text")
+
     parser.add_argument(
         "--no_erg",
         action="store_true",
@@ -67,6 +110,13 @@ if __name__ == "__main__":
         type=str,
         help="preferred bluetooth device to connect to")
 
+    parser.add_argument(
+        "--bluetooth_backend",
+        action="store",
+        choices=bluetooth.BACKENDS,
+        default=bluetooth.backend,
+        help="run the heart rate monitor connection in a subprocess or a thread")
+
     parser.add_argument(
         "--bluetooth_scan",
         action="store_true",
@@ -102,6 +152,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     volume = min(max(args.volume, 0.0), 1.0) if args.volume is not None else 1.0
+    bluetooth.backend = args.bluetooth_backend
 
     try:
         if args.metronome:
@@ -148,9 +199,28 @@ if __name__ == "__main__":
             metronome_test_main(device_addr)
             sys.exit(0)
 
+        if args.benchmark:
+            # only benchmarks need everything it imports
+            from benchmark import benchmark_main
+            benchmark_main(args.benchmark)
+            sys.exit(0)
+
+        if args.import_logs:
+            assert(args.store != None)
+            import_main(args.store)
+            sys.exit(0)
+
+        if args.export:
+            gui = Display(headless_size=args.resolution)
+            export_main(
+                gui, args.export, normalized_bpm_range=args.global_bpm_range, store_path=args.store)
+            sys.exit(0)
+
         if args.viewer:
             gui = Display()
-            viewer_main(gui, normalized_bpm_range=args.global_bpm_range)
+            viewer_main(
+                gui, normalized_bpm_range=args.global_bpm_range, store_path=args.store,
+                frame_stats=args.frame_stats)
             sys.exit(0)
 
         elif args.replay:
@@ -161,6 +231,7 @@ if __name__ == "__main__":
                     speed_divisor = 1 / args.speed
 
                 gui = Display()
+                gui.profiler.enabled = args.profile
                 workout_main(
                     gui,
                     volume,
@@ -179,6 +250,7 @@ if __name__ == "__main__":
             else:
                 device_addr = None
             gui = Display()
+            gui.profiler.enabled = args.profile
             workout_main(gui, volume, device_addr, no_save=args.no_save, bpm_debug=args.bpm_debug)
     except Exception:
         print(traceback.format_exc())
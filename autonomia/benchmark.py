@@ -0,0 +1,466 @@
+import os
+import time
+import json
+import random
+import tempfile
+import multiprocessing
+import functools
+from array import array
+from misc import lerp
+from gui import Display
+from session import LOG_FIELDS, Session, Phase, Event
+from log_index import LogIndex
+from resting_bpm import RestingBPM
+from quiesce import FullStop
+from workout import PleaseBegin, IntervalRunner
+from pulse_ring import PulseRing, iter_records, RECORD
+import heart_rate
+from hrm_corpus import hrm_corpus
+import bluetooth
+import log_index
+
+
+def make_log(path, rows, seed):
+    """
+    Write a synthetic JSON session log with `rows` rows of a wandering heart rate.
+    """
+    rng = random.Random(seed)
+    phase_length = rows // 5
+    t = 1_700_000_000.0 + seed * 86_400
+    bpm = 70.0
+    average = bpm
+
+    log = []
+    for i in range(rows):
+        t += rng.uniform(.5, 1.5)
+        bpm = min(max(bpm + rng.choice((-1, 0, 0, 1)), 50), 190)
+        average += (bpm - average) * .2
+        phase = min(i // phase_length, 4)
+        log.append((phase, t, bpm, rng.randint(18, 30), rng.randint(80, 220), i * 3.5, 0, 0, average, 0))
+
+    blob = {
+        "date" : time.strftime("%Y_%m_%d", time.gmtime(t)),
+        "start_time" : "06:00 AM",
+        "manual_session" : False,
+        "resting_bpm" : 70,
+        "intervals" : 1,
+        "calibration_time" : 300,
+        "steady_time" : 1200,
+        "cooldown_time" : 300,
+        "target_low" : 50,
+        "target_high" : 65,
+        "target_bias" : .5,
+        "log_headers" : LOG_FIELDS,
+        "log" : log,
+    }
+    with open(path, "w") as out_file:
+        out_file.write(json.dumps(blob))
+
+
+def make_corpus(directory, count, rows):
+    paths = []
+    for seed in range(count):
+        path = os.path.join(directory, f"2024_01_01_rowing_log_{seed:03}.json")
+        make_log(path, rows, seed)
+        paths.append(path)
+    return paths
+
+
+def ingest_benchmark(count=300, rows=2400):
+    """
+    Time how long it takes to build the viewer's log index from scratch with different numbers of
+    worker processes.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"writing {count} logs of {rows} rows...")
+        paths = make_corpus(directory, count, rows)
+
+        cores = os.cpu_count() or 1
+        worker_counts = sorted(set([1, 2, 4, 8, 16, cores]))
+        baseline = None
+        for workers in worker_counts:
+            if workers > cores:
+                continue
+            index = LogIndex(os.path.join(directory, f"index_{workers}.json"))
+            start = time.perf_counter()
+            index.update(paths, workers=workers)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"{workers:3} workers: {elapsed:7.3f}s  ({baseline / elapsed:.2f}x)")
+
+
+# The loop-at-a-time versions of the viewer's derivations, kept as a reference for the ones in
+# `log_index` which must produce exactly the same output.
+
+def reference_dedupe(times, bpms):
+    points = [[times[0], bpms[0]]]
+    last = points[-1]
+    for t, bpm in zip(times[1:], bpms[1:]):
+        if bpm != last[1]:
+            points[-1][0] = (points[-1][0] + last[0]) * .5
+            points.append([t, bpm])
+        last = [t, bpm]
+    if points[-1] is not last:
+        points.append(last)
+    return points
+
+
+def reference_find_peaks(points):
+    peaks = [points[0]]
+    for i in range(1, len(points) - 1):
+        a = points[i - 1][1]
+        b = points[i][1]
+        c = points[i + 1][1]
+        if (a < b and c < b) or (a > b and c > b):
+            peaks.append(points[i])
+    if peaks[-1] is not points[-1]:
+        peaks.append(points[-1])
+    return peaks
+
+
+def reference_pare(points, span=1):
+    min_list = []
+    max_list = []
+    for i in range(len(points)):
+        low = max(0, i - span)
+        high = max(0, i + span + 1)
+        neighbors = [bpm for t, bpm in points[low:high]]
+        if points[i][1] == min(neighbors):
+            min_list.append(points[i])
+        if points[i][1] == max(neighbors):
+            max_list.append(points[i])
+    return min_list, max_list
+
+
+def reference_soften(points):
+    reduced = [list(points[0])]
+    for i in range(1, len(points) - 1):
+        a = points[i - 1][1]
+        b = points[i][1]
+        c = points[i + 1][1]
+        reduced.append([points[i][0], lerp(lerp(a, b, .5), lerp(b, c, .5), .5)])
+    reduced.append(list(points[-1]))
+    return reduced
+
+
+def reference_derive(times, bpms):
+    peaks = reference_find_peaks(reference_dedupe(times, bpms))
+    peak_mins, peak_maxs = reference_pare(peaks)
+    peak_mins = reference_pare(peak_mins)[0]
+    peak_maxs = reference_pare(peak_maxs)[1]
+    octaves = []
+    softened = peaks
+    for i in range(5):
+        softened = reference_soften(softened)
+        octaves.append(softened)
+    return peaks, peak_mins, peak_maxs, octaves
+
+
+def derive(times, bpms):
+    peaks = log_index.find_peaks(*log_index.dedupe(times, bpms))
+    peak_mins, peak_maxs = log_index.pare(*peaks)
+    peak_mins = log_index.pare(*peak_mins)[0]
+    peak_maxs = log_index.pare(*peak_maxs)[1]
+    octaves = []
+    softened = peaks
+    for i in range(5):
+        softened = log_index.soften(*softened)
+        octaves.append(softened)
+    return peaks, peak_mins, peak_maxs, octaves
+
+
+def as_points(series):
+    return [[t, bpm] for t, bpm in zip(*series)]
+
+
+def derive_benchmark(lengths=(10_000, 100_000, 1_000_000), repeats=3):
+    """
+    Compare the viewer's derivations against the reference loops on long sessions.
+    """
+    for rows in lengths:
+        rng = random.Random(rows)
+        times = array("d")
+        bpms = array("d")
+        t = 0.0
+        bpm = 120.0
+        for i in range(rows):
+            t += rng.uniform(.3, 1.2)
+            bpm = min(max(bpm + rng.choice((-1, 0, 0, 1)), 50), 190)
+            times.append(t)
+            bpms.append(bpm)
+
+        peaks, peak_mins, peak_maxs, octaves = derive(times, bpms)
+        assert((as_points(peaks), as_points(peak_mins), as_points(peak_maxs), [as_points(octave) for octave in octaves])
+               == reference_derive(times, bpms))
+
+        timings = []
+        for function in (reference_derive, derive):
+            best = None
+            for i in range(repeats):
+                start = time.perf_counter()
+                function(times, bpms)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+        print(f"{rows:9} rows: loops {timings[0]:7.3f}s, columns {timings[1]:7.3f}s  ({timings[0] / timings[1]:.2f}x)")
+
+
+def text_benchmark(frames=600, repeats=5):
+    """
+    Time each of the live workout screens with and without the text surface cache, keeping the
+    best of `repeats` runs.  Only the drawing is timed, not presenting the frame.
+    """
+    gui = Display()
+    session = Session()
+    session.resting_bpm = 60
+
+    def screens():
+        resting = RestingBPM(session)
+        begin = PleaseBegin()
+        intervals = IntervalRunner(session, False)
+        quiesce = FullStop()
+        remaining = "12:34"
+
+        def calibration(event):
+            session.phase = Phase.CALIBRATION
+            intervals.update(session, event)
+            intervals.draw(gui, session, event.bpm_rolling_average, remaining)
+
+        def steady(event):
+            session.phase = Phase.STEADY
+            intervals.update(session, event)
+            intervals.draw(gui, session, event.bpm_rolling_average, remaining)
+
+        return [
+            ("resting", lambda event: resting(gui, session, event)),
+            ("begin", lambda event: begin(gui, session, event)),
+            ("calibration", calibration),
+            ("steady", steady),
+            ("quiesce", lambda event: quiesce(gui, session, event)),
+        ]
+
+    def events():
+        # a new reading roughly every 15 frames, like the live screens get
+        rng = random.Random(0)
+        bpm = 120
+        for frame in range(frames):
+            if frame % 15 == 0:
+                bpm = min(max(bpm + rng.choice((-1, 0, 1)), 90), 150)
+            event = Event()
+            event.time = frame / 60
+            event.bpm = bpm
+            event.bpm_rolling_average = bpm
+            event.cadence = 24
+            event.watts = 150 + bpm % 3
+            yield event
+
+    results = {}
+    for cache_size in (0, gui.text_cache_size):
+        gui.text_cache_size = cache_size
+        gui.text_cache.clear()
+        best = {}
+        for attempt in range(repeats):
+            for name, draw in screens():
+                hits, misses, entries = gui.text_cache_stats()
+                start = time.perf_counter()
+                for event in events():
+                    draw(event)
+                elapsed = time.perf_counter() - start
+                after = gui.text_cache_stats()
+                run = (elapsed / frames, after[0] - hits, after[1] - misses)
+                if name not in best or run[0] < best[name][0]:
+                    best[name] = run
+        for name, run in best.items():
+            results.setdefault(name, []).append(run)
+
+    for name, ((before, *ignored), (after, hits, misses)) in results.items():
+        print(
+            f"{name:12} {before * 1000:7.3f} ms -> {after * 1000:7.3f} ms per frame "
+            f"({before / after:.2f}x), {hits} hits, {misses} misses")
+
+
+def queue_producer(queue, packets, rr_per_packet):
+    """
+    Sends pulses the way the bluetooth process used to, one queued message per rr interval.
+    """
+    for i in range(packets):
+        for j in range(rr_per_packet):
+            queue.put(("pulse", 800 + i % 200))
+    queue.put(("done", None))
+
+
+def ring_producer(ring, packets, rr_per_packet):
+    """
+    Sends pulses the way the bluetooth process does now, one ring record per notification.
+    """
+    for i in range(packets):
+        ring.write(time.monotonic(), 75, 0b_0001_0000, [800 + i % 200] * rr_per_packet)
+
+
+def ipc_benchmark(packets=200_000, rr_per_packet=2, poll_interval=.001):
+    """
+    Push notifications from a subprocess to this one as fast as it can send them, far faster than
+    any heart beats, and time how long it takes for all of them to be read.  The reader polls
+    every `poll_interval` seconds like the UI does.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    rr_count = packets * rr_per_packet
+
+    queue = ctx.Queue()
+    producer = ctx.Process(target=queue_producer, args=(queue, packets, rr_per_packet))
+    received = 0
+    reads = 0
+    start = time.perf_counter()
+    producer.start()
+    done = False
+    while not done:
+        while True:
+            try:
+                message_type, data = queue.get_nowait()
+            except:
+                break
+            reads += 1
+            if message_type == "done":
+                done = True
+                break
+            received += 1
+        time.sleep(poll_interval)
+    queue_time = time.perf_counter() - start
+    producer.join()
+    print(
+        f"queue: {received} rr intervals in {queue_time:.3f}s ({received / queue_time:,.0f}/s), "
+        f"{reads} reads")
+
+    ring = PulseRing(ctx)
+    producer = ctx.Process(target=ring_producer, args=(ring, packets, rr_per_packet))
+    received = 0
+    reads = 0
+    start = time.perf_counter()
+    producer.start()
+    while producer.is_alive() or ring.read_count < ring.written.value:
+        data = ring.read()
+        reads += 1
+        for record in iter_records(data):
+            received += len(record[3])
+        time.sleep(poll_interval)
+    ring_time = time.perf_counter() - start
+    producer.join()
+    print(
+        f"ring:  {received} rr intervals in {ring_time:.3f}s ({received / ring_time:,.0f}/s), "
+        f"{reads} reads, {ring.dropped} notifications dropped")
+
+    print(f"{queue_time / ring_time:.2f}x, {rr_count - received} rr intervals lost")
+
+
+def reference_decode(packet):
+    """
+    The decoder the bluetooth process used before `heart_rate`, which returns the bpm and the rr
+    intervals as sent.
+    """
+    flags = packet[0]
+
+    bpm_offset = 1
+    bpm_bytes = 1 + (flags & heart_rate.HEART_RATE_VALUE_FORMAT_BIT)
+
+    energy_offset = bpm_offset + bpm_bytes
+    energy_bytes = (flags & heart_rate.ENERGY_EXPENDED_STATUS_BIT) >> 2
+
+    rr_offset = energy_offset + energy_bytes
+    rr_bytes = 2
+    rr_count = (len(packet) - rr_offset) // rr_bytes
+
+    bpm = int.from_bytes(packet[bpm_offset:bpm_offset + bpm_bytes], 'little')
+    rr_intervals = None
+
+    if (flags & heart_rate.RR_INTERVAL_BIT) == heart_rate.RR_INTERVAL_BIT:
+        rr_intervals = [
+            int.from_bytes(
+                packet[rr_offset + rr_bytes * i:rr_offset + rr_bytes * (i+1)],
+                'little')
+            for i in range(rr_count)]
+
+    return bpm, rr_intervals
+
+
+def hrm_benchmark(repeats=5):
+    """
+    Time the heart rate measurement decoders against the decoder they replaced, over every
+    combination of flags.  `heart_rate_test` checks what they decode to.
+    """
+    packets = [packet for packet, rr_intervals, expected in hrm_corpus()]
+    buffer = bytearray(RECORD.size)
+    decoders = (
+        ("reference", reference_decode),
+        ("decode", heart_rate.decode),
+        ("decode_into", lambda packet: heart_rate.decode_into(packet, buffer, 0, 0.0)),
+    )
+    timings = []
+    for name, decoder in decoders:
+        best = None
+        for i in range(repeats):
+            start = time.perf_counter()
+            for packet in packets:
+                decoder(packet)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best)
+        print(
+            f"{name:12} {best / len(packets) * 1e9:7.0f}ns per notification "
+            f"({timings[0] / best:.2f}x)")
+
+
+def backend_benchmark(notifications=50_000, poll_interval=.001):
+    """
+    Compare the bluetooth backends on how long it takes from `bluetooth.start` until the first
+    pulse can be read, and on what each message costs to reach the application.  A replayed
+    stream of notifications stands in for the heart rate monitor.
+    """
+    packet = bytes([heart_rate.RR_INTERVAL_BIT, 75]) + (800).to_bytes(2, 'little') * 2
+    monitor = functools.partial(bluetooth.replay_monitor, [packet] * notifications)
+
+    previous = bluetooth.backend
+    try:
+        for backend in bluetooth.BACKENDS:
+            bluetooth.backend = backend
+            pulses = 0
+            messages = 0
+
+            start = time.perf_counter()
+            bluetooth.start("replay", monitor)
+            while pulses == 0:
+                pulses = len(bluetooth.read_pulses()) // RECORD.size
+                time.sleep(poll_interval)
+            first_pulse = time.perf_counter()
+
+            # the replay can lap the pulse ring, but every message arrives
+            while messages < notifications:
+                messages += len(bluetooth.read_messages())
+                pulses += len(bluetooth.read_pulses()) // RECORD.size
+                time.sleep(poll_interval)
+            streamed = time.perf_counter()
+
+            bluetooth.stop()
+            stopped = time.perf_counter()
+            print(
+                f"{backend:8} first pulse {(first_pulse - start) * 1000:8.1f}ms, "
+                f"{(streamed - first_pulse) / notifications * 1e6:6.2f}us per notification, "
+                f"stop {(stopped - streamed) * 1000:6.1f}ms")
+    finally:
+        bluetooth.backend = previous
+
+
+BENCHMARKS = {
+    "backends" : backend_benchmark,
+    "derive" : derive_benchmark,
+    "hrm" : hrm_benchmark,
+    "ingest" : ingest_benchmark,
+    "ipc" : ipc_benchmark,
+    "text" : text_benchmark,
+}
+
+
+def benchmark_main(name):
+    if name not in BENCHMARKS:
+        print(f"unknown benchmark {name}, choose from {', '.join(sorted(BENCHMARKS))}")
+        return
+    BENCHMARKS[name]()
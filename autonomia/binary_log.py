@@ -0,0 +1,218 @@
+import mmap
+import struct
+import sys
+from array import array
+from event_log import COLUMNS
+
+
+# Binary session logs are laid out as a fixed size header followed by one or more blocks of
+# events.  Every block holds a fixed width array for each column in `event_log.COLUMNS`, followed
+# by a table of the error messages for rows in that block.  Everything is little endian, and each
+# array starts on an 8 byte boundary so it can be used in place from a memory mapping.
+#
+#     header:  HEADER, padded to HEADER_SIZE bytes
+#     block:   BLOCK (byte length of the block, row count, error count)
+#              one array per column, each padded to 8 bytes
+#              ERROR (row index, byte length) + utf-8 message, padded to 8 bytes, per error
+
+MAGIC = b"AUTONLOG"
+VERSION = 2
+EXTENSION = ".bin"
+
+# How many of the columns in `event_log.COLUMNS` each version of the format stores.  Columns added
+# since are left zeroed when an older log is read.
+VERSION_COLUMNS = {
+    1 : 10,
+    2 : len(COLUMNS),
+}
+
+HEADER = struct.Struct("<8sHHI16s16sdqddddddQQ")
+HEADER_SIZE = 128
+BLOCK = struct.Struct("<QII")
+ERROR = struct.Struct("<QI4x")
+
+MANUAL_SESSION_FLAG = 0b_0000_0001
+
+_SWAP = sys.byteorder != "little"
+
+
+def _pad(length):
+    return -length % 8
+
+
+def _number(value):
+    """
+    Header values are stored as doubles, but most of them started out as ints.
+    """
+    return int(value) if value.is_integer() else value
+
+
+def is_binary_log(path):
+    with open(path, "rb") as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+
+def pack_header(header, rows=0, blocks=0):
+    flags = 0
+    if header["manual_session"]:
+        flags |= MANUAL_SESSION_FLAG
+
+    packed = HEADER.pack(
+        MAGIC, VERSION, flags, 0,
+        header["date"].encode("utf-8"),
+        header["start_time"].encode("utf-8"),
+        header["resting_bpm"],
+        header["intervals"],
+        header["calibration_time"],
+        header["steady_time"],
+        header["cooldown_time"],
+        header["target_low"],
+        header["target_high"],
+        header["target_bias"],
+        rows,
+        blocks)
+    return packed + bytes(HEADER_SIZE - len(packed))
+
+
+def unpack_header(buffer):
+    (magic, version, flags, _, date, start_time, resting_bpm, intervals,
+     calibration_time, steady_time, cooldown_time, target_low, target_high, target_bias,
+     rows, blocks) = HEADER.unpack_from(buffer)
+
+    if magic != MAGIC:
+        raise ValueError("not a binary session log")
+    if version > VERSION:
+        raise ValueError(f"unsupported binary session log version {version}")
+
+    header = {
+        "date" : date.rstrip(b"\0").decode("utf-8"),
+        "start_time" : start_time.rstrip(b"\0").decode("utf-8"),
+        "manual_session" : (flags & MANUAL_SESSION_FLAG) != 0,
+        "resting_bpm" : _number(resting_bpm),
+        "intervals" : intervals,
+        "calibration_time" : _number(calibration_time),
+        "steady_time" : _number(steady_time),
+        "cooldown_time" : _number(cooldown_time),
+        "target_low" : _number(target_low),
+        "target_high" : _number(target_high),
+        "target_bias" : target_bias,
+    }
+    return header, rows, blocks
+
+
+def pack_block(log, start=0, stop=None):
+    """
+    Pack rows [start, stop) of an `EventLog` into a block.
+    """
+    if stop is None:
+        stop = len(log)
+
+    chunks = []
+    for column in log.columns:
+        values = column[start:stop]
+        if _SWAP:
+            values.byteswap()
+        data = values.tobytes()
+        chunks.append(data)
+        chunks.append(bytes(_pad(len(data))))
+
+    errors = sorted((index, error) for index, error in log.errors.items() if start <= index < stop)
+    for index, error in errors:
+        message = str(error).encode("utf-8")
+        chunks.append(ERROR.pack(index - start, len(message)))
+        chunks.append(message)
+        chunks.append(bytes(_pad(len(message))))
+
+    body = b"".join(chunks)
+    return BLOCK.pack(BLOCK.size + len(body), stop - start, len(errors)) + body
+
+
+def write(path, header, log):
+    with open(path, "wb") as out_file:
+        out_file.write(pack_header(header, len(log), 1))
+        out_file.write(pack_block(log))
+
+
+class BinaryLog:
+    """
+    A binary session log opened for reading.  The file is memory mapped, and for a log written in
+    a single block the columns are memoryviews straight into the mapping, so opening a log costs
+    the same no matter how many events it holds.  Logs made of several blocks have each column
+    joined into one array.
+
+    Blocks that run past the end of the file are ignored, which is what a log that was still
+    being written looks like after a crash.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as infile:
+            self.map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self.map)
+        self.header, _, _ = unpack_header(view)
+        self.stored_columns = COLUMNS[:VERSION_COLUMNS[HEADER.unpack_from(view)[1]]]
+
+        self.blocks = []
+        offset = HEADER_SIZE
+        while offset + BLOCK.size <= len(view):
+            length, rows, error_count = BLOCK.unpack_from(view, offset)
+            if length < BLOCK.size or offset + length > len(view):
+                break
+            self.blocks.append(self._read_block(view, offset + BLOCK.size, rows, error_count))
+            offset += length
+        view.release()
+
+        self.columns = {}
+        self.errors = {}
+        if len(self.blocks) == 1 and not _SWAP:
+            self.columns, self.errors = self.blocks[0]
+        else:
+            for name, typecode in self.stored_columns:
+                column = array(typecode)
+                for block_columns, _ in self.blocks:
+                    column.frombytes(block_columns[name].cast("B"))
+                if _SWAP:
+                    column.byteswap()
+                self.columns[name] = column
+            row_offset = 0
+            for block_columns, block_errors in self.blocks:
+                for index, error in block_errors.items():
+                    self.errors[index + row_offset] = error
+                row_offset += len(block_columns[COLUMNS[0][0]])
+
+    def __len__(self):
+        return len(self.columns[COLUMNS[0][0]])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Unmap the file.  Columns that were used in place are released along with it, so anything
+        still holding one has to be done with it first.
+        """
+        for block_columns, _ in self.blocks:
+            for column in block_columns.values():
+                column.release()
+        self.blocks = []
+        self.columns = {}
+        self.map.close()
+
+    def _read_block(self, view, offset, rows, error_count):
+        columns = {}
+        for name, typecode in self.stored_columns:
+            length = rows * array(typecode).itemsize
+            columns[name] = view[offset:offset + length].cast(typecode)
+            offset += length + _pad(length)
+
+        errors = {}
+        for i in range(error_count):
+            index, length = ERROR.unpack_from(view, offset)
+            offset += ERROR.size
+            errors[index] = bytes(view[offset:offset + length]).decode("utf-8")
+            offset += length + _pad(length)
+
+        return columns, errors
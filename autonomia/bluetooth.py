@@ -1,152 +1,250 @@
 
+import collections
 import multiprocessing
+import threading
 import time
 
 import asyncio
 from bleak import BleakClient
 from bleak import BleakScanner
 from bleak.exc import BleakError
+from heart_rate import decode_into
+from pulse_ring import PulseRing, iter_records
 
 BATTERY_LEVEL_CHARACTERISTIC = "00002a19-0000-1000-8000-00805f9b34fb"
 
 HRM_CHARACTERISTIC = "00002a37-0000-1000-8000-00805f9b34fb"
-HEART_RATE_VALUE_FORMAT_BIT = 0b_0000_0001
-SENSOR_CONTACT_STATUS_BIT   = 0b_0000_0010
-SENSOR_CONTACT_SUPPORT_BIT  = 0b_0000_0100
-ENERGY_EXPENDED_STATUS_BIT  = 0b_0000_1000
-RR_INTERVAL_BIT             = 0b_0001_0000
 
 
+# Where the bleak event loop runs.  "process" gives it a spawned subprocess of its own, which
+# keeps bleak's work off the UI's interpreter but costs a fresh interpreter on every start and a
+# pickled queue message for each status.  "thread" runs it in a thread of this process and
+# hands messages over through a deque.
+BACKENDS = ("process", "thread")
+backend = "process"
+
 _proc = None
-_command_queue = None
+_thread = None
+_command_pipe = None
+_command_reader = None
 _event_queue = None
+_event_deque = None
+_pulse_ring = None
 
 
-def decode(packet):
-    flags = packet[0]
-
-    bpm_offset = 1
-    bpm_bytes = 1 + (flags & HEART_RATE_VALUE_FORMAT_BIT)
-
-    energy_offset = bpm_offset + bpm_bytes
-    energy_bytes = (flags & ENERGY_EXPENDED_STATUS_BIT) >> 2
-
-    rr_offset = energy_offset + energy_bytes
-    rr_bytes = 2
-    rr_count = (len(packet) - rr_offset) // rr_bytes
-
-    bpm = int.from_bytes(packet[bpm_offset:bpm_offset + bpm_bytes], 'little')
-    rr_intervals = None
-
-    if (flags & RR_INTERVAL_BIT) == RR_INTERVAL_BIT:
-        rr_intervals = [
-            int.from_bytes(
-                packet[rr_offset + rr_bytes * i:rr_offset + rr_bytes * (i+1)],
-                'little')
-            for i in range(rr_count)]
-
-    return bpm, rr_intervals
-
-
-async def heart_monitor_runner(command_queue, event_queue, device_address):
+async def heart_monitor_session(post, pulse_ring, device_address):
+    """
+    Forward the heart rate monitor's readings until a fatal error, reconnecting whenever the
+    connection is lost.  While connected this sleeps until bleak reports a disconnect or the
+    monitor stops sending rr intervals.  Messages for the application are passed to `post`.
+    """
     reconnect = True
+    closing = False
+    wake = asyncio.Event()
 
     def heart_event(sender, packet):
         nonlocal reconnect
-        nonlocal event_queue
-        bpm, rr_intervals = decode(packet)
+        received = time.monotonic()
+        buffer, offset = pulse_ring.next_slot()
+        try:
+            rr_count = decode_into(packet, buffer, offset, received)
+        except ValueError as error:
+            post(("status", f"ignored notification: {error}"))
+            return
 
-        if not (rr_intervals and len(rr_intervals) > 0):
-            event_queue.put(("status", "reconnecting: missing rr_intervals"))
+        if rr_count == 0:
+            post(("status", "reconnecting: missing rr_intervals"))
             reconnect = True
+            wake.set()
         else:
-            for rr_interval in rr_intervals:
-                event_queue.put(("pulse", rr_interval))
+            pulse_ring.commit()
+
+    def disconnected(client):
+        nonlocal reconnect
+        # disconnecting on purpose calls this too
+        if not closing and not reconnect:
+            post(("status", "reconnecting: connection lost"))
+            reconnect = True
+            wake.set()
 
     while reconnect == True:
         reconnect = False
+        closing = False
+        wake.clear()
         try:
-            async with BleakClient(device_address) as client:
+            async with BleakClient(device_address, disconnected_callback=disconnected) as client:
                 await client.start_notify(HRM_CHARACTERISTIC, heart_event)
 
                 try:
                     battery_level = await client.read_gatt_char(BATTERY_LEVEL_CHARACTERISTIC)
                     battery_level = int.from_bytes(battery_level, byteorder='little')
-                    event_queue.put(("battery", battery_level))
-
-                    while not reconnect:
-                        if not client.is_connected:
-                            event_queue.put(("status", "reconnecting: connection lost"))
-                            reconnect = True
-                            break
-
-                        try:
-                            packet = command_queue.get_nowait()
-                        except:
-                            packet = None
-
-                        if packet == "halt":
-                            event_queue.put(("status", "halt requested by application"))
-                            reconnect = False
-                            break
+                    post(("battery", battery_level))
 
-                        await asyncio.sleep(0.1)
+                    if not client.is_connected:
+                        disconnected(client)
+                    await wake.wait()
                 except Exception as e:
-                    event_queue.put(("fatal", e))
+                    post(("fatal", e))
+                finally:
+                    closing = True
 
                 if client.is_connected:
                     await client.stop_notify(HRM_CHARACTERISTIC)
 
         except BleakError as error:
-            event_queue.put(("fatal", error))
+            post(("fatal", error))
             await asyncio.sleep(0.1)
 
 
-def heart_monitor_proc(command_queue, event_queue, device_address):
+async def replay_monitor(packets, post, pulse_ring, device_address):
     """
-    Entry point for the metronome subprocess.
+    Stands in for `heart_monitor_session` when benchmarking the backends.  Delivers the packets
+    as notifications as fast as it can, each with a status message, then waits to be halted.
     """
+    for index, packet in enumerate(packets):
+        buffer, offset = pulse_ring.next_slot()
+        decode_into(packet, buffer, offset, time.monotonic())
+        pulse_ring.commit()
+        post(("status", index))
+        if index % 64 == 63:
+            # let the halt through, like the notifications from bleak would
+            await asyncio.sleep(0)
+    await asyncio.Event().wait()
+
+
+async def heart_monitor_runner(command_pipe, post, pulse_ring, device_address, monitor):
+    """
+    Run the heart rate monitor session until it fails or the application asks it to halt.
+    Commands are read from the pipe as soon as they arrive, so a halt takes effect right away,
+    even in the middle of connecting.
+    """
+    loop = asyncio.get_running_loop()
+    halted = asyncio.Event()
 
-    asyncio.run(heart_monitor_runner(command_queue, event_queue, device_address))
+    def command_ready():
+        try:
+            command = command_pipe.recv()
+        except EOFError:
+            # the application went away without asking
+            command = "halt"
 
+        if command == "halt":
+            loop.remove_reader(command_pipe.fileno())
+            halted.set()
+
+    loop.add_reader(command_pipe.fileno(), command_ready)
+
+    session = asyncio.create_task(monitor(post, pulse_ring, device_address))
+    halt = asyncio.create_task(halted.wait())
+    await asyncio.wait([session, halt], return_when=asyncio.FIRST_COMPLETED)
+
+    if halt.done():
+        post(("status", "halt requested by application"))
+        session.cancel()
+    else:
+        loop.remove_reader(command_pipe.fileno())
+        halt.cancel()
+
+    try:
+        await session
+    except asyncio.CancelledError:
+        pass
 
-def start(device_address):
+
+def heart_monitor_proc(command_pipe, post, pulse_ring, device_address, monitor=heart_monitor_session):
+    """
+    Entry point for the heart rate monitor's subprocess or thread.
+    """
+
+    def post_received(message):
+        # stamped like the pulse records, so the application can put the two back in order
+        post((*message, time.monotonic()))
+
+    asyncio.run(heart_monitor_runner(command_pipe, post_received, pulse_ring, device_address, monitor))
+
+
+def start(device_address, monitor=heart_monitor_session):
     """
-    Start the metronome subprocess if one is not running.
+    Start the heart rate monitor's subprocess or thread, depending on `backend`, if one is not
+    running.
     """
     global _proc
-    global _command_queue
+    global _thread
+    global _command_pipe
+    global _command_reader
     global _event_queue
+    global _event_deque
+    global _pulse_ring
 
     assert(device_address != None)
+    assert(backend in BACKENDS)
 
-    if not _proc:
+    if not _proc and not _thread:
         ctx = multiprocessing.get_context('spawn')
-        _command_queue = ctx.Queue()
-        _event_queue = ctx.Queue()
-        _proc = ctx.Process(target=heart_monitor_proc, args=(_command_queue, _event_queue, device_address))
-        _proc.start()
+        command_reader, _command_pipe = ctx.Pipe(duplex=False)
+        _pulse_ring = PulseRing(ctx)
+
+        if backend == "process":
+            _event_queue = ctx.Queue()
+            _proc = ctx.Process(
+                target=heart_monitor_proc,
+                args=(command_reader, _event_queue.put, _pulse_ring, device_address, monitor))
+            _proc.start()
+            # the subprocess has its own copy now
+            command_reader.close()
+        else:
+            # appending and popping from opposite ends of a deque are atomic, so the thread and
+            # the application don't need a lock between them
+            _event_deque = collections.deque()
+            _command_reader = command_reader
+            _thread = threading.Thread(
+                target=heart_monitor_proc,
+                args=(command_reader, _event_deque.append, _pulse_ring, device_address, monitor),
+                daemon=True)
+            _thread.start()
 
 
 def stop():
     """
-    Halt the metronome subprocess if one is running.
+    Halt the heart rate monitor's subprocess or thread if one is running.
     """
     global _proc
-    global _command_queue
+    global _thread
+    global _command_pipe
+    global _command_reader
     global _event_queue
+    global _event_deque
+    global _pulse_ring
 
-    if _proc:
-        _command_queue.put("halt")
-        _proc.join()
+    if _proc or _thread:
+        try:
+            _command_pipe.send("halt")
+        except OSError:
+            # the subprocess already exited after a fatal error
+            pass
+        if _proc:
+            _proc.join()
+        else:
+            _thread.join()
+            _command_reader.close()
+        _command_pipe.close()
 
-        _command_queue = None
+        _command_pipe = None
+        _command_reader = None
         _event_queue = None
+        _event_deque = None
+        _pulse_ring = None
         _proc = None
+        _thread = None
 
 
-def read():
+def read_messages():
+    """
+    Returns the status, battery and error messages from the subprocess or thread since the last
+    call, as (message type, data, time.monotonic() it was sent at).
+    """
     global _event_queue
+    global _event_deque
     messages = []
     if _event_queue:
         while True:
@@ -155,9 +253,44 @@ def read():
             except:
                 break
             messages.append(event)
+    elif _event_deque is not None:
+        while True:
+            try:
+                event = _event_deque.popleft()
+            except IndexError:
+                break
+            messages.append(event)
     return messages
 
 
+def read_pulses():
+    """
+    Returns every notification received since the last call as packed records, which
+    `pulse_ring.iter_records` unpacks.
+    """
+    if _pulse_ring:
+        return _pulse_ring.read()
+    return b""
+
+
+def read():
+    """
+    Returns the (message type, data) messages from the subprocess or thread since the last call,
+    with a ("pulse", rr) message for each new rr interval, in the order they were received.
+    """
+    messages = read_messages()
+    merged = []
+    pending = 0
+    for received, bpm, flags, rr_intervals in iter_records(read_pulses()):
+        while pending < len(messages) and messages[pending][2] <= received:
+            merged.append(messages[pending][:2])
+            pending += 1
+        for rr_interval in rr_intervals:
+            merged.append(("pulse", rr_interval))
+    merged.extend(message[:2] for message in messages[pending:])
+    return merged
+
+
 def scan(timeout=5):
     device_scan = {}
 
@@ -23,3 +23,18 @@ class Config:
 
         # Number of minutes to spend cooling down after an interval.
         self.cooldown_time = 1
+
+        # Number of seconds between writes of the session log to disk while a workout is running.
+        self.flush_interval = 5
+
+        # Number of recent events kept in memory once they have been written to disk.
+        self.log_tail_length = 600
+
+        # Times per second the erg or heart rate monitor is asked for new data during a workout.
+        self.sample_rate = 1
+
+        # Times per second the keyboard is checked during a workout.
+        self.input_rate = 100
+
+        # Times per second the screen is drawn during a workout.
+        self.render_rate = 60
@@ -0,0 +1,225 @@
+from array import array
+from enum import IntEnum
+
+
+class Phase(IntEnum):
+    INVALID = -1
+    RESTING_BPM = 0
+    PENDING = 1
+    CALIBRATION = 2
+    STEADY = 3
+    COOLDOWN = 4
+    FULLSTOP = 5
+    RESULTS = 6
+    SHUTDOWN = 7
+
+
+_PHASES = {int(phase) : phase for phase in Phase}
+
+
+# The name and array typecode of every per-event column, in storage order.
+COLUMNS = (
+    ("phase", "b"),
+    ("time", "d"),
+    ("bpm", "d"),
+    ("bpm_rolling_average", "d"),
+    ("rr_interval", "d"),
+    ("cadence", "q"),
+    ("target_cadence", "q"),
+    ("watts", "q"),
+    ("target_watts", "q"),
+    ("distance", "d"),
+    ("receive_latency", "d"),
+    ("display_latency", "d"),
+    ("stream_drift", "d"),
+)
+
+COLUMN_NAMES = tuple(name for name, typecode in COLUMNS)
+
+_ERROR = len(COLUMNS)
+
+
+class _Column:
+    """
+    Exposes one column of an event's log as an attribute of the event.
+    """
+
+    def __init__(self, index, typecode):
+        self.index = index
+        self.convert = int if typecode in "bq" else float
+
+    def __get__(self, event, owner=None):
+        if event is None:
+            return self
+        if event._log is None:
+            return event._row[self.index]
+        return event._log.columns[self.index][event._index]
+
+    def __set__(self, event, value):
+        value = self.convert(value)
+        if event._log is None:
+            event._row[self.index] = value
+        else:
+            event._log.columns[self.index][event._index] = value
+
+
+class _PhaseColumn(_Column):
+    def __get__(self, event, owner=None):
+        if event is None:
+            return self
+        return _PHASES[_Column.__get__(self, event, owner)]
+
+
+class _ErrorColumn:
+    """
+    Errors are rare, so they live in a side table keyed by row index rather than a column.
+    """
+
+    def __get__(self, event, owner=None):
+        if event is None:
+            return self
+        if event._log is None:
+            return event._row[_ERROR]
+        return event._log.errors.get(event._index, False)
+
+    def __set__(self, event, value):
+        if event._log is None:
+            event._row[_ERROR] = value
+        elif value:
+            event._log.errors[event._index] = value
+        else:
+            event._log.errors.pop(event._index, None)
+
+
+class Event:
+    """
+    A single row of an `EventLog`.  A freshly constructed event holds its own values until it is
+    appended to a log, after which it reads and writes that log's columns directly.
+    """
+
+    __slots__ = ("_log", "_index", "_row")
+
+    phase = _PhaseColumn(0, "b")
+    time = _Column(1, "d")
+    bpm = _Column(2, "d")
+    bpm_rolling_average = _Column(3, "d")
+    rr_interval = _Column(4, "d")
+    cadence = _Column(5, "q")
+    target_cadence = _Column(6, "q")
+    watts = _Column(7, "q")
+    target_watts = _Column(8, "q")
+    distance = _Column(9, "d")
+    receive_latency = _Column(10, "d")
+    display_latency = _Column(11, "d")
+    stream_drift = _Column(12, "d")
+    error = _ErrorColumn()
+
+    def __init__(self, log=None, index=0):
+        self._log = log
+        self._index = index
+        self._row = None
+        if log is None:
+            self._row = [int(Phase.INVALID), 0.0, 0.0, 0.0, 0.0, 0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, False]
+
+    def __copy__(self):
+        """
+        Copies are always detached from the log, so they can be edited freely.
+        """
+        event = Event()
+        event._row = self.values()
+        return event
+
+    def values(self):
+        """
+        All of the event's values in column order, followed by its error.
+        """
+        if self._log is None:
+            return list(self._row)
+        row = [column[self._index] for column in self._log.columns]
+        row.append(self._log.errors.get(self._index, False))
+        return row
+
+
+class EventLog:
+    """
+    Struct-of-arrays storage for a session's events.  Each column in `COLUMNS` is a typed array
+    available as an attribute of the same name, and error messages are kept in a side table
+    keyed by row index.  Indexing the log returns `Event` views over its rows.
+
+    Columns that are already typed arrays or memoryviews of the right type are adopted without
+    copying them.
+    """
+
+    def __init__(self, columns=None, errors=None):
+        if columns is None:
+            columns = {}
+        length = max((len(values) for values in columns.values()), default=0)
+
+        self.columns = []
+        for name, typecode in COLUMNS:
+            values = columns.get(name)
+            if values is None:
+                column = array(typecode, bytes(array(typecode).itemsize * length))
+            elif isinstance(values, memoryview) and values.format == typecode:
+                # used in place, which leaves the log read only
+                column = values
+            elif isinstance(values, array) and values.typecode == typecode:
+                column = values
+            elif typecode in "bq":
+                column = array(typecode, (int(value) for value in values))
+            else:
+                column = array(typecode, values)
+            assert(len(column) == length)
+            self.columns.append(column)
+            setattr(self, name, column)
+
+        self.errors = errors if errors is not None else {}
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Event(self, i) for i in range(*index.indices(len(self)))]
+        length = len(self)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("event index out of range")
+        return Event(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Event(self, index)
+
+    def append(self, event):
+        """
+        Copy an event into the log.  The event is then rebound to its new row, so later edits to
+        it (such as filling in targets) land in the log.
+        """
+        index = len(self)
+        row = event.values()
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        if row[_ERROR]:
+            self.errors[index] = row[_ERROR]
+
+        event._log = self
+        event._index = index
+        event._row = None
+
+    def extend(self, other, start=0, stop=None):
+        """
+        Bulk copy rows [start, stop) of another log onto the end of this one.
+        """
+        if stop is None:
+            stop = len(other)
+        offset = len(self) - start
+        for column, source in zip(self.columns, other.columns):
+            if isinstance(source, memoryview):
+                column.frombytes(source[start:stop].cast("B"))
+            else:
+                column.extend(source[start:stop])
+        for index, error in other.errors.items():
+            if start <= index < stop:
+                self.errors[index + offset] = error
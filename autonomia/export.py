@@ -0,0 +1,171 @@
+import os
+import json
+import multiprocessing
+import pygame
+from gui import Display
+from log_index import SessionSummary
+from log_viewer import ResultsGraph, MODE_NAMES
+from store import SessionStore
+from workout import find_logs, load_summaries, find_bpm_min_max
+
+
+DEFAULT_RESOLUTION = (1920, 1080)
+
+# Kept next to the images, recording how each log's images were rendered.
+MANIFEST_NAME = "export_manifest.json"
+
+
+def parse_resolution(text):
+    """
+    Parses a resolution written as WIDTHxHEIGHT, such as 1920x1080.
+    """
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def export_paths(output_dir, log_path):
+    """
+    Returns the image path for each view mode of a log.
+    """
+    name = os.path.splitext(os.path.basename(log_path))[0]
+    return [os.path.join(output_dir, f"{name}_{mode}_{mode_name}.png") for mode, mode_name in enumerate(MODE_NAMES)]
+
+
+def load_manifest(output_dir):
+    """
+    Returns how the images in `output_dir` were rendered, keyed by log path.
+    """
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), "r") as infile:
+            return json.loads(infile.read())
+    except (OSError, ValueError):
+        # without one, every image is rendered again
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as out_file:
+        out_file.write(json.dumps(manifest))
+    os.replace(temp_path, path)
+
+
+def render_settings(bpm_stats, global_bpm, resolution):
+    """
+    Everything besides the log that changes what its images look like, in the form the manifest
+    stores it.
+    """
+    return {
+        "bpm_stats" : list(bpm_stats),
+        "global_bpm" : global_bpm,
+        "resolution" : list(resolution),
+    }
+
+
+def up_to_date(output_dir, log_path, manifest, settings):
+    """
+    True if every image for the log exists, is newer than the log, and was rendered with the same
+    settings.  With a global bpm range, a new session can change the scale of every image.
+    """
+    if manifest.get(os.path.abspath(log_path)) != settings:
+        return False
+
+    log_mtime = os.stat(log_path).st_mtime
+    for path in export_paths(output_dir, log_path):
+        try:
+            if os.stat(path).st_mtime < log_mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def export_session(gui, summary, bpm_stats, global_bpm, output_dir):
+    """
+    Render every view mode of a session and save each one as a PNG.  Only the static part of the
+    view is drawn, as there is no mouse to follow.
+    """
+    view = ResultsGraph(summary, gui, bpm_stats, global_bpm)
+    surface = pygame.Surface((gui.w, gui.h))
+    for mode, path in enumerate(export_paths(output_dir, summary.path)):
+        view.draw_static(gui, surface, mode)
+        # written under another name first so an interrupted export never looks up to date
+        temp_path = path[:-len(".png")] + ".tmp.png"
+        pygame.image.save(surface, temp_path)
+        os.replace(temp_path, path)
+
+
+# Each worker process has its own headless display, and its own connection to the session store
+# if there is one.
+_worker_gui = None
+_worker_store = None
+
+
+def _init_worker(resolution, store_path):
+    global _worker_gui, _worker_store
+    # SDL would otherwise swallow the SIGTERM the pool stops its workers with
+    os.environ["SDL_NO_SIGNAL_HANDLERS"] = "1"
+    _worker_gui = Display(headless_size=resolution)
+    if store_path is not None:
+        _worker_store = SessionStore(store_path)
+
+
+def _export_in_worker(job):
+    path, summary, bpm_stats, global_bpm, output_dir = job
+    export_session(_worker_gui, SessionSummary(path, summary, _worker_store), bpm_stats, global_bpm, output_dir)
+    return path
+
+
+def export_main(gui, output_dir, normalized_bpm_range=False, store_path=None, workers=None):
+    """
+    Render the graphs of every logged session to image files in `output_dir`, skipping the logs
+    that haven't changed since they were last exported.  `gui` should be a headless `Display`,
+    and the sessions are spread over `workers` processes, or one per core if that is None.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    store = None
+    if store_path:
+        store = SessionStore(store_path)
+    summaries = load_summaries(find_logs(store), store)
+
+    global_stats = None
+    if normalized_bpm_range:
+        global_stats = find_bpm_min_max(summaries)
+
+    resolution = (gui.w, gui.h)
+    manifest = load_manifest(output_dir)
+    settings = {}
+    jobs = []
+    for summary in summaries:
+        bpm_stats = global_stats if normalized_bpm_range else find_bpm_min_max([summary])
+        settings[summary.path] = render_settings(bpm_stats, normalized_bpm_range, resolution)
+        if up_to_date(output_dir, summary.path, manifest, settings[summary.path]):
+            continue
+        jobs.append((summary.path, summary.summary, bpm_stats, normalized_bpm_range, output_dir))
+
+    print(f"exporting {len(jobs)} of {len(summaries)} sessions to {output_dir}")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+
+    # Only the logs whose images were all written get recorded, even if the export is cut short.
+    try:
+        if workers <= 1:
+            for path, summary, bpm_stats, global_bpm, output_dir in jobs:
+                export_session(gui, SessionSummary(path, summary, store), bpm_stats, global_bpm, output_dir)
+                manifest[os.path.abspath(path)] = settings[path]
+                print(f"\t{path}")
+        else:
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(workers, _init_worker, (resolution, store_path)) as pool:
+                for path in pool.imap_unordered(_export_in_worker, jobs):
+                    manifest[os.path.abspath(path)] = settings[path]
+                    print(f"\t{path}")
+                pool.close()
+                pool.join()
+    finally:
+        if jobs:
+            save_manifest(output_dir, manifest)
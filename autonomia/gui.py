@@ -4,40 +4,293 @@ import time
 import math
 import sys
 import os
+import json
+import hashlib
+import collections
+from array import array
 from importlib import resources
 import pygame
 import pygame.font
 import pygame.sysfont
 import pygame.display
 import media
-from misc import lerp
+from misc import lerp, percentiles
 import metronome
 import bluetooth
 
 
+# Where the results of matching the font sizes are kept between runs.
+FONT_CALIBRATION_PATH = "font_calibration.json"
+
+
+def load_font_calibration(key):
+    """
+    Returns the saved font sizes and offsets if they were saved under the same key, else None.
+    """
+    try:
+        with open(FONT_CALIBRATION_PATH, "r") as infile:
+            calibration = json.loads(infile.read())
+        if calibration["key"] == key:
+            return calibration
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_font_calibration(key, sizes, offsets):
+    """
+    Save the font sizes and offsets, replacing whatever was saved before.  Failing to save only
+    means calibrating again next time.
+    """
+    calibration = {
+        "key" : key,
+        "sizes" : sizes,
+        "offsets" : offsets,
+    }
+    temp_path = f"{FONT_CALIBRATION_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "w") as out_file:
+            out_file.write(json.dumps(calibration))
+        os.replace(temp_path, FONT_CALIBRATION_PATH)
+    except OSError:
+        pass
+
+
+class FrameStats:
+    """
+    Counts how often a render loop wakes up and draws, and how much CPU time the process spends,
+    and prints the rates every `interval` seconds.
+    """
+
+    def __init__(self, label, interval=5):
+        self.label = label
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.cpu_start = time.process_time()
+        self.wakeups = 0
+        self.frames = 0
+
+    def tick(self, drew):
+        self.wakeups += 1
+        if drew:
+            self.frames += 1
+
+        elapsed = time.monotonic() - self.start
+        if elapsed >= self.interval:
+            cpu = (time.process_time() - self.cpu_start) / elapsed * 100
+            print(
+                f"{self.label}: {self.frames / elapsed:.1f} fps, "
+                f"{self.wakeups / elapsed:.1f} wakeups/s, {cpu:.1f}% cpu")
+            self.reset()
+
+
+# Where the profiler's per-phase timing summary is written.
+PROFILE_PATH = "frame_profile.txt"
+
+
+class ProfileSection:
+    """
+    Times the code inside a `with` block and records it with the profiler under `name`.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NoSection:
+    """
+    Stands in for `ProfileSection` while the profiler is off, so timing costs nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_SECTION = NoSection()
+
+
+class Profiler:
+    """
+    Times the parts of each frame of the live workout loops.  While enabled, the time between
+    frames is graphed in a corner of the screen along with its percentiles and a breakdown of the
+    last frame, and totals for every section are kept for each phase of the session.
+    """
+
+    def __init__(self, path=PROFILE_PATH, history=240):
+        self.path = path
+        self.enabled = False
+        self.session = None
+
+        self.frame_times = collections.deque(maxlen=history)
+        self.last_present = None
+        self.frame_sections = {}
+        self.last_frame_sections = {}
+
+        # Every frame time for each phase, for the percentiles in the summary.
+        self.phase_frames = {}
+        # [count, total, max] seconds for each (phase, section).
+        self.totals = {}
+
+    def phase_name(self):
+        if self.session is None:
+            return "none"
+        return str(self.session.phase._name_).lower()
+
+    def section(self, name):
+        """
+        Returns a context manager that times its block as part of the current frame.
+        """
+        if not self.enabled:
+            return NO_SECTION
+        return ProfileSection(self, name)
+
+    def record(self, name, elapsed):
+        self.frame_sections[name] = self.frame_sections.get(name, 0) + elapsed
+
+        stats = self.totals.get((self.phase_name(), name))
+        if stats is None:
+            stats = self.totals[(self.phase_name(), name)] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+    def frame(self):
+        """
+        Marks the end of a frame.
+        """
+        now = time.perf_counter()
+        if self.last_present is not None:
+            frame_time = now - self.last_present
+            self.frame_times.append(frame_time)
+            self.phase_frames.setdefault(self.phase_name(), array("d")).append(frame_time)
+        self.last_present = now
+        self.last_frame_sections = self.frame_sections
+        self.frame_sections = {}
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        # the gap while it was off isn't a frame
+        self.last_present = None
+        self.frame_times.clear()
+
+    def draw(self, gui):
+        """
+        Draw the frame time graph and readouts over whatever is on screen.
+        """
+        width = self.frame_times.maxlen * 2
+        height = 120
+        x1 = 10
+        y2 = gui.h - 10
+        y1 = y2 - height
+        scale = height / (1 / 30) # the top of the graph is 30 fps
+
+        pygame.draw.rect(gui.screen, (0, 0, 0), (x1, y1, width, height))
+        for i, frame_time in enumerate(self.frame_times):
+            bar = min(frame_time * scale, height)
+            color = (0, 192, 0) if frame_time <= 1 / 55 else (192, 0, 0)
+            pygame.draw.line(gui.screen, color, (x1 + i * 2, y2), (x1 + i * 2, y2 - bar))
+        sixty = y2 - scale / 60
+        pygame.draw.line(gui.screen, (128, 128, 128), (x1, sixty), (x1 + width, sixty))
+
+        lines = []
+        if self.frame_times:
+            p50, p95, p99 = percentiles(self.frame_times, (.5, .95, .99))
+            lines.append(f"frame p50 {p50 * 1000:.1f}  p95 {p95 * 1000:.1f}  p99 {p99 * 1000:.1f} ms")
+        for name, elapsed in self.last_frame_sections.items():
+            lines.append(f"{name} {elapsed * 1000:.2f} ms")
+
+        for i, line in enumerate(reversed(lines)):
+            gui.draw_text(line, x1 + width + 10, y2 - i * 20, (255, 255, 0), font="tiny", y_align=1)
+
+    def save(self):
+        """
+        Write the timing totals for each phase to the summary file, if anything was timed.
+        """
+        if not self.totals and not self.phase_frames:
+            return
+
+        phases = sorted(set(self.phase_frames) | set(phase for phase, name in self.totals))
+        lines = []
+        for phase in phases:
+            lines.append(f"{phase}:")
+            frames = self.phase_frames.get(phase)
+            if frames:
+                p50, p95, p99 = percentiles(frames, (.5, .95, .99))
+                lines.append(
+                    f"    {len(frames)} frames, mean {sum(frames) / len(frames) * 1000:.2f} ms, "
+                    f"p50 {p50 * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms, "
+                    f"max {max(frames) * 1000:.2f} ms")
+            for (section_phase, name), (count, total, longest) in sorted(self.totals.items()):
+                if section_phase != phase:
+                    continue
+                lines.append(
+                    f"    {name:16} {count:8} calls, total {total:8.3f} s, "
+                    f"mean {total / count * 1000:.3f} ms, max {longest * 1000:.3f} ms")
+
+        try:
+            with open(self.path, "w") as out_file:
+                out_file.write("\n".join(lines) + "\n")
+            print(f"frame profile written to {self.path}")
+        except OSError:
+            pass
+
+
 class Display:
-    def __init__(self):
+    def __init__(self, headless_size=None):
+        """
+        If `headless_size` is given, nothing is shown.  Instead the display is a (width, height)
+        surface drawn with SDL's dummy video driver, for rendering straight to image files.
+        """
         # Correct support of HiDPI on Linux requires setting both of these environment variables as well
         # as passing the desired unscaled resolution to `pygame.display.set_mode` via the `size` parameter.
         os.environ["SDL_VIDEODRIVER"] = "wayland,x11"
         os.environ["SDL_VIDEO_SCALE_METHOD"] = "letterbox"
+        if headless_size is not None:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
 
         pygame.init()
         pygame.font.init()
         pygame.display.init()
 
         self.session = None
+        self.exposed = True
+        self.profiler = Profiler()
+
+        # Rendered text, keyed by (text, font, color, antialias), most recently used last.
+        self.text_cache = collections.OrderedDict()
+        self.text_cache_size = 256
+        self.text_cache_hits = 0
+        self.text_cache_misses = 0
 
         font_name = None
 
-        self.default_fonts = {
-            "tiny" : pygame.sysfont.SysFont(font_name, 32),    # M-height is 16 px?
-            "smol" : pygame.sysfont.SysFont(font_name, 64),    # M-height is 32 px?
-            "regular" : pygame.sysfont.SysFont(font_name, 96), # M-height is 48 px?
-            "big" : pygame.sysfont.SysFont(font_name, 200),    # M-height is 100 px?
-            "bigger" : pygame.sysfont.SysFont(font_name, 400), # M-height is 200 px?
+        # The point size of the system font that each named font should match.
+        default_sizes = {
+            "tiny" : 32,    # M-height is 16 px?
+            "smol" : 64,    # M-height is 32 px?
+            "regular" : 96, # M-height is 48 px?
+            "big" : 200,    # M-height is 100 px?
+            "bigger" : 400, # M-height is 200 px?
         }
 
+        self.default_fonts = {
+            name : pygame.sysfont.SysFont(font_name, size) for name, size in default_sizes.items()}
+
         def m_height(font):
             """
             Returns the M-height of the font, hopefully in pixels.
@@ -70,47 +323,84 @@ class Display:
             to be the desired pixel size.  This, however, appears to be a lie.  As the actual
             units seem to be completely arbitrary and change wildly from font to font, we take
             a numeric approach here to force it back into the realm of logic and reason.
+
+            M height only ever grows with the size, so this bisects for the smallest size that
+            matches, or the closest one if none match exactly.
             """
-            counterpart = self.default_fonts[name]
-            target_size = m_height(counterpart)
-            guess = 100
-            font = None
-            for i in range(500):
-                font = pygame.font.Font(font_path, int(guess))
-                size = m_height(font)
-                if size == target_size:
-                    return font
+            target_size = m_height(self.default_fonts[name])
+            heights = {}
+
+            def height_at(size):
+                if size not in heights:
+                    heights[size] = m_height(pygame.font.Font(font_path, size))
+                return heights[size]
+
+            low = 0
+            high = 100
+            while height_at(high) < target_size:
+                low = high
+                high *= 2
+            while high - low > 1:
+                middle = (low + high) // 2
+                if height_at(middle) < target_size:
+                    low = middle
                 else:
-                    guess *= target_size / size
-            return font
+                    high = middle
+
+            if low == 0 or height_at(high) - target_size <= target_size - height_at(low):
+                return high
+            return low
+
+        # Matching the sizes means loading the font over and over, so the results are kept on
+        # disk for as long as nothing they depend on changes.
+        calibration_key = "|".join([
+            hashlib.sha256(font_path.read_bytes()).hexdigest(),
+            pygame.font.get_default_font(),
+            pygame.version.ver,
+            ".".join(str(part) for part in pygame.font.get_sdl_ttf_version()),
+            ",".join(f"{name}={size}" for name, size in default_sizes.items())])
+        calibration = load_font_calibration(calibration_key)
+
+        if calibration is None:
+            font_sizes = {name : match_size(name) for name in self.default_fonts.keys()}
+        else:
+            font_sizes = calibration["sizes"]
 
         self.fonts = {}
         if True:
             for name in self.default_fonts.keys():
-                self.fonts[name] = match_size(name)
+                self.fonts[name] = pygame.font.Font(font_path, font_sizes[name])
         else:
             self.fonts = self.default_fonts
 
-        self.font_offsets = {}
-        for name, font in self.fonts.items():
-            counterpart = self.default_fonts[name]
+        if calibration is None:
+            self.font_offsets = {}
+            for name, font in self.fonts.items():
+                counterpart = self.default_fonts[name]
+
+                target_margin = (
+                    counterpart.get_ascent() - m_ascent(counterpart),
+                    counterpart.get_descent() - m_descent(counterpart))
 
-            target_margin = (
-                counterpart.get_ascent() - m_ascent(counterpart),
-                counterpart.get_descent() - m_descent(counterpart))
+                font_margin = (
+                    font.get_ascent() - m_ascent(counterpart),
+                    font.get_descent() - m_descent(counterpart))
 
-            font_margin = (
-                font.get_ascent() - m_ascent(counterpart),
-                font.get_descent() - m_descent(counterpart))
+                self.font_offsets[name] = (
+                    int(target_margin[0] - font_margin[0]),
+                    -int(target_margin[1] - font_margin[1]))
 
-            self.font_offsets[name] = (
-                int(target_margin[0] - font_margin[0]),
-                -int(target_margin[1] - font_margin[1]))
+            save_font_calibration(calibration_key, font_sizes, self.font_offsets)
+        else:
+            self.font_offsets = {name : tuple(offset) for name, offset in calibration["offsets"].items()}
 
-        self.screen = pygame.display.set_mode(
-            size = pygame.display.list_modes()[0],
-            flags = pygame.FULLSCREEN,
-            vsync = True)
+        if headless_size is not None:
+            self.screen = pygame.display.set_mode(size = headless_size)
+        else:
+            self.screen = pygame.display.set_mode(
+                size = pygame.display.list_modes()[0],
+                flags = pygame.FULLSCREEN,
+                vsync = True)
 
         pygame.display.set_caption("autonomia")
 
@@ -125,32 +415,97 @@ class Display:
     def request_shutdown(self):
         if self.session:
             self.session.save_to_disk(abort = True)
+        self.profiler.save()
         pygame.display.quit()
         pygame.quit()
         metronome.stop()
         bluetooth.stop()
         sys.exit(0)
 
-    def pump_events(self):
+    def handle_events(self, events):
         keys = []
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
                 self.request_shutdown()
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED, pygame.WINDOWRESTORED):
+                # whatever was on screen may be gone, so the next frame has to draw all of it
+                self.exposed = True
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     self.request_shutdown()
+                elif event.key == pygame.K_F3:
+                    self.profiler.toggle()
                 else:
                     keys.append(event.key)
         return keys
 
-    def present(self):
-        pygame.display.flip()
+    def pump_events(self):
+        with self.profiler.section("events"):
+            return self.handle_events(pygame.event.get())
+
+    def wait_events(self, timeout):
+        """
+        Sleep until there is input or `timeout` seconds have passed.  Returns the keys pressed and
+        whether anything at all happened, such as the mouse moving or the window being exposed.
+        """
+        event = pygame.event.wait(int(timeout * 1000))
+        if event.type == pygame.NOEVENT:
+            return [], False
+        return self.handle_events([event] + pygame.event.get()), True
+
+    def present(self, rects=None):
+        """
+        Show what has been drawn.  If `rects` is given, only those parts of the screen changed.
+        """
+        profiler = self.profiler
+        if profiler.enabled and rects is None:
+            with profiler.section("overlay"):
+                profiler.draw(self)
+
+        with profiler.section("present"):
+            if rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(rects)
+
+        if profiler.enabled:
+            profiler.frame()
 
     def clear(self, color):
         self.screen.fill(color)
 
-    def draw_text(self, msg, x, y, color=(255, 255, 255), font="regular", x_align=0, y_align=0):
-        surface = self.fonts[font].render(str(msg), True, color)
+    def render_text(self, msg, font, color, antialias=True):
+        """
+        Render a line of text, reusing the surface from an earlier call with the same arguments if
+        it is still in the cache.
+        """
+        if isinstance(color, (tuple, list)):
+            # pygame truncates fractional channels anyway, and this keeps fading colors cacheable
+            color = tuple(int(channel) for channel in color)
+        key = (str(msg), font, color, antialias)
+
+        surface = self.text_cache.get(key)
+        if surface is not None:
+            self.text_cache.move_to_end(key)
+            self.text_cache_hits += 1
+            return surface
+
+        self.text_cache_misses += 1
+        surface = self.fonts[font].render(key[0], antialias, color)
+        if self.text_cache_size > 0:
+            self.text_cache[key] = surface
+            while len(self.text_cache) > self.text_cache_size:
+                self.text_cache.popitem(last=False)
+        return surface
+
+    def text_cache_stats(self):
+        """
+        Returns the hits, misses and current number of entries of the text cache.
+        """
+        return self.text_cache_hits, self.text_cache_misses, len(self.text_cache)
+
+    def draw_text(self, msg, x, y, color=(255, 255, 255), font="regular", x_align=0, y_align=0, target=None):
+        surface = self.render_text(msg, font, color)
         if x is None:
             x = (self.w - surface.get_width()) * .5
         elif x_align > 0:
@@ -164,13 +519,15 @@ class Display:
             top, bottom = self.font_offsets.get(font)
             y += lerp(top, -bottom, y_align)
 
-        self.screen.blit(surface, (x, y))
+        if target is None:
+            target = self.screen
+        return target.blit(surface, (x, y))
 
-    def draw_x_label(self, msg, x, y, color=(255, 255, 255), font="smol", y_align=0):
-        self.draw_text(msg, x, y, color, font, x_align = .5, y_align = y_align)
+    def draw_x_label(self, msg, x, y, color=(255, 255, 255), font="smol", y_align=0, target=None):
+        return self.draw_text(msg, x, y, color, font, x_align = .5, y_align = y_align, target = target)
 
-    def draw_y_label(self, msg, x, y, color=(255, 255, 255), font="smol", x_align=1):
-        self.draw_text(msg, x, y, color, font, x_align = x_align, y_align = .5)
+    def draw_y_label(self, msg, x, y, color=(255, 255, 255), font="smol", x_align=1, target=None):
+        return self.draw_text(msg, x, y, color, font, x_align = x_align, y_align = .5, target = target)
 
     def draw_stat(self, label, value, col, row,
                   value_color=(255, 255, 255),
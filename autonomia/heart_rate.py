@@ -0,0 +1,91 @@
+import struct
+from itertools import repeat
+from operator import mul
+from pulse_ring import RECORD, MAX_RR_INTERVALS, RR_INTERVAL_MS
+
+
+# The flags that open every Heart Rate Measurement (0x2A37) notification.
+HEART_RATE_VALUE_FORMAT_BIT = 0b_0000_0001
+SENSOR_CONTACT_STATUS_BIT   = 0b_0000_0010
+SENSOR_CONTACT_SUPPORT_BIT  = 0b_0000_0100
+ENERGY_EXPENDED_STATUS_BIT  = 0b_0000_1000
+RR_INTERVAL_BIT             = 0b_0001_0000
+
+_LAYOUT_BITS = HEART_RATE_VALUE_FORMAT_BIT | ENERGY_EXPENDED_STATUS_BIT | RR_INTERVAL_BIT
+
+_ZEROS = (0,) * MAX_RR_INTERVALS
+
+# A struct for each combination of flags and length seen so far, with the number of rr intervals
+# it holds.
+_layouts = {}
+
+
+def layout(flags, length):
+    """
+    Returns the struct that unpacks a whole notification with these flags and this many bytes,
+    and how many rr intervals are at the end of it.
+    """
+    key = (flags & _LAYOUT_BITS, length)
+    found = _layouts.get(key)
+    if found is None:
+        fields = "<B"
+        fields += "H" if flags & HEART_RATE_VALUE_FORMAT_BIT else "B"
+        if flags & ENERGY_EXPENDED_STATUS_BIT:
+            fields += "H"
+        size = struct.calcsize(fields)
+        if length < size:
+            raise ValueError(f"heart rate measurement is {length} bytes, expected at least {size}")
+
+        rr_count = 0
+        if flags & RR_INTERVAL_BIT:
+            rr_count = (length - size) // 2
+        found = (struct.Struct(f"{fields}{rr_count}H"), rr_count)
+        _layouts[key] = found
+    return found
+
+
+def sensor_contact(flags):
+    """
+    True or False if the sensor reports whether it's touching skin, None if it can't tell.
+    """
+    if flags & SENSOR_CONTACT_SUPPORT_BIT:
+        return (flags & SENSOR_CONTACT_STATUS_BIT) != 0
+    return None
+
+
+def decode(packet):
+    """
+    Decodes a Heart Rate Measurement notification into (bpm, sensor contact, energy expended,
+    rr intervals).  Sensor contact is as `sensor_contact` returns it, energy expended is in kJ or
+    None if the notification doesn't carry it, and the rr intervals are a tuple in milliseconds.
+    """
+    flags = packet[0]
+    fields, rr_count = layout(flags, len(packet))
+    values = fields.unpack_from(packet)
+
+    energy_expended = None
+    if flags & ENERGY_EXPENDED_STATUS_BIT:
+        energy_expended = values[2]
+
+    rr_intervals = ()
+    if rr_count > 0:
+        rr_intervals = tuple(map(mul, values[-rr_count:], repeat(RR_INTERVAL_MS)))
+    return values[1], sensor_contact(flags), energy_expended, rr_intervals
+
+
+def decode_into(packet, buffer, offset, received):
+    """
+    Decodes a notification straight into a `pulse_ring.RECORD` at `offset` in `buffer`, stamped
+    with the time it was received.  Returns how many rr intervals it carried.  Any beyond the
+    most a record holds are dropped.
+    """
+    flags = packet[0]
+    fields, rr_count = layout(flags, len(packet))
+    values = fields.unpack_from(packet)
+
+    rr_intervals = values[len(values) - rr_count:]
+    rr_count = min(rr_count, MAX_RR_INTERVALS)
+    RECORD.pack_into(
+        buffer, offset, received, values[1], flags, rr_count,
+        *rr_intervals[:MAX_RR_INTERVALS], *_ZEROS[rr_count:])
+    return rr_count
@@ -0,0 +1,54 @@
+import sys
+import heart_rate
+from pulse_ring import RECORD, MAX_RR_INTERVALS, iter_records
+from hrm_corpus import encode_hrm, hrm_corpus
+
+
+def check(condition, message):
+    """
+    Like assert, but still checked when python is run with -O.
+    """
+    if not condition:
+        raise AssertionError(message)
+
+
+def test_decode():
+    for packet, rr_intervals, expected in hrm_corpus():
+        check(heart_rate.decode(packet) == expected, f"decode({packet.hex()})")
+        check(heart_rate.decode(memoryview(packet)) == expected, f"decode(memoryview({packet.hex()}))")
+
+
+def test_decode_into():
+    buffer = bytearray(RECORD.size)
+    for packet, rr_intervals, expected in hrm_corpus():
+        rr_count = heart_rate.decode_into(packet, buffer, 0, 1.5)
+        check(rr_count == min(len(rr_intervals), MAX_RR_INTERVALS), f"decode_into({packet.hex()}) count")
+        record, = iter_records(buffer)
+        check(
+            record == (1.5, expected[0], packet[0], list(expected[3][:MAX_RR_INTERVALS])),
+            f"decode_into({packet.hex()})")
+
+
+def test_truncated():
+    """
+    Packets too short for the fields their flags promise are rejected.
+    """
+    for flags in range(0b_0010_0000):
+        packet = encode_hrm(flags, 0, 0, ())
+        for length in range(1, len(packet)):
+            try:
+                heart_rate.decode(packet[:length])
+            except ValueError:
+                continue
+            raise AssertionError(f"decode({packet[:length].hex()}) accepted a truncated packet")
+
+
+TESTS = (test_decode, test_decode_into, test_truncated)
+
+
+if __name__ == "__main__":
+    for test in TESTS:
+        test()
+        print(f"{test.__name__}: ok")
+    print(f"{len(hrm_corpus())} notifications decoded correctly")
+    sys.exit(0)
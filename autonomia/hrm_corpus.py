@@ -0,0 +1,48 @@
+import heart_rate
+
+
+# The most a notification can hold with the default ATT MTU of 23 bytes.
+HRM_PAYLOAD = 20
+
+
+def encode_hrm(flags, bpm, energy_expended, rr_intervals):
+    packet = bytes([flags])
+    packet += bpm.to_bytes(1 + (flags & heart_rate.HEART_RATE_VALUE_FORMAT_BIT), 'little')
+    if flags & heart_rate.ENERGY_EXPENDED_STATUS_BIT:
+        packet += energy_expended.to_bytes(2, 'little')
+    for rr_interval in rr_intervals:
+        packet += rr_interval.to_bytes(2, 'little')
+    return packet
+
+
+def hrm_corpus():
+    """
+    A notification for every combination of flags, with the smallest and largest values each
+    field can hold and every number of rr intervals that fits, paired with the rr intervals it
+    carries and what it should decode to.
+    """
+    rr_values = (0, 1, 1023, 1024, 1025, 65535)
+    corpus = []
+    for flags in range(0b_0010_0000):
+        wide = flags & heart_rate.HEART_RATE_VALUE_FORMAT_BIT
+        bpms = (0, 1, 60, 255) + ((256, 65535) if wide else ())
+        energies = (0, 1, 65535) if flags & heart_rate.ENERGY_EXPENDED_STATUS_BIT else (None,)
+        contact = None
+        if flags & heart_rate.SENSOR_CONTACT_SUPPORT_BIT:
+            contact = bool(flags & heart_rate.SENSOR_CONTACT_STATUS_BIT)
+
+        for bpm in bpms:
+            for energy_expended in energies:
+                header = len(encode_hrm(flags, bpm, energy_expended, ()))
+                max_rr = (HRM_PAYLOAD - header) // 2 if flags & heart_rate.RR_INTERVAL_BIT else 0
+                for rr_count in range(max_rr + 1):
+                    for rr_value in rr_values:
+                        rr_intervals = [(rr_value + i) % 65536 for i in range(rr_count)]
+                        packet = encode_hrm(flags, bpm, energy_expended, rr_intervals)
+                        expected = (
+                            bpm, contact, energy_expended,
+                            tuple(rr_interval * 1000 / 1024 for rr_interval in rr_intervals))
+                        corpus.append((packet, rr_intervals, expected))
+                        if rr_count == 0:
+                            break
+    return corpus
@@ -0,0 +1,46 @@
+import json
+
+
+LOG_KEY = '"log": ['
+
+
+def read(path, chunk_rows=4096):
+    """
+    Open a JSON session log and return its header along with a generator that parses the rows of
+    its log lazily, in lists of up to `chunk_rows` rows.
+
+    Logs written by `Session.save_to_disk` always end with the log, so the header can be parsed
+    on its own without touching the rows.  Anything else falls back to parsing the whole file.
+    """
+    with open(path, "r") as infile:
+        text = infile.read()
+
+    # The rows are only numbers, so nothing after the log key may be quoted.
+    key = text.rfind(LOG_KEY)
+    if key >= 0 and text.find('"', key + len(LOG_KEY)) < 0 and text.rstrip().endswith("]}"):
+        try:
+            header = json.loads(text[:key].rstrip().rstrip(",") + "}")
+        except json.JSONDecodeError:
+            header = None
+        if header is not None and "log" not in header:
+            return header, _chunks(text, key + len(LOG_KEY), chunk_rows)
+
+    blob = json.loads(text)
+    rows = blob.pop("log")
+    return blob, iter([rows])
+
+
+def _chunks(text, start, chunk_rows):
+    # Rows are flat lists of numbers, so each one ends at the next "]".
+    end = text.rstrip().rindex("]", 0, -1)
+    while start < end:
+        stop = start
+        for i in range(chunk_rows):
+            close = text.find("]", stop, end)
+            if close < 0:
+                break
+            stop = close + 1
+        if stop == start:
+            return
+        yield json.loads("[" + text[start:stop].lstrip(", \n") + "]")
+        start = stop
@@ -0,0 +1,370 @@
+import os
+import math
+import json
+import multiprocessing
+from bisect import bisect_left
+from itertools import compress, repeat
+from operator import add, sub, mul, truediv, lt, gt, eq, ne, and_, or_
+from session import ReplaySession, Phase
+from store import SessionStore
+
+
+# Bump this whenever `summarize` changes what it derives, so stale entries get rebuilt.
+INDEX_VERSION = 3
+
+# Where the index lives, next to the logs.
+INDEX_PATH = "log_index.json"
+
+# The event columns the viewer's summaries are derived from.
+GRAPH_COLUMNS = ("phase", "time", "bpm", "bpm_rolling_average")
+
+# The event columns a viewer page loads for its raw series and hover readout.
+VIEW_COLUMNS = GRAPH_COLUMNS + ("cadence", "watts", "rr_interval")
+
+# Seconds between the points of the rolling average kept in a summary.  It is already smooth, and
+# every row of it would make the index far larger.
+AVERAGE_STEP = 5
+
+# The series a summary holds, each as a list of times and a list of bpm.
+SERIES = ("peaks", "peak_mins", "peak_maxs", "average")
+
+
+def dedupe(times, bpms):
+    """
+    Collapse runs of repeated bpm readings into a single point at the middle of the run.  Every
+    run but the last is placed halfway between its first and last readings, and the final
+    reading is kept as its own point.  Returns the times and bpm of the points as two lists.
+    """
+    length = len(bpms)
+    changes = list(compress(range(1, length), map(ne, bpms[1:], bpms)))
+    starts = [0] + changes
+    ends = map(sub, changes, repeat(1))
+
+    run_times = list(map(mul, map(add, map(times.__getitem__, starts[:-1]), map(times.__getitem__, ends)), repeat(.5)))
+    run_times.append(times[starts[-1]])
+    run_bpms = list(map(bpms.__getitem__, starts))
+
+    if length > 1:
+        run_times.append(times[length - 1])
+        run_bpms.append(bpms[length - 1])
+    return run_times, run_bpms
+
+
+def find_peaks(times, bpms):
+    """
+    Keeps the first and last points and every point that is a strict local minimum or maximum.
+    """
+    before = bpms[:-2]
+    middle = bpms[1:-1]
+    after = bpms[2:]
+    keep = [True]
+    keep.extend(map(
+        or_,
+        map(and_, map(lt, before, middle), map(lt, after, middle)),
+        map(and_, map(gt, before, middle), map(gt, after, middle))))
+    if len(bpms) > 1:
+        keep.append(True)
+    return list(compress(times, keep)), list(compress(bpms, keep))
+
+
+def pare(times, bpms):
+    """
+    Splits out the points that are the lowest and highest among themselves and their immediate
+    neighbors.
+    """
+    before = bpms[:1] + bpms[:-1]
+    after = bpms[1:] + bpms[-1:]
+    is_min = list(map(eq, bpms, map(min, before, bpms, after)))
+    is_max = list(map(eq, bpms, map(max, before, bpms, after)))
+    return (
+        (list(compress(times, is_min)), list(compress(bpms, is_min))),
+        (list(compress(times, is_max)), list(compress(bpms, is_max))))
+
+
+def soften(times, bpms):
+    """
+    Smooth the interior points with a [.25, .5, .25] kernel, evaluated as the same pair of
+    nested lerps the viewer has always used so the result is bit for bit the same.
+    """
+    half = repeat(.5)
+    left = map(add, map(mul, half, bpms[:-2]), map(mul, bpms[1:-1], half))
+    right = map(add, map(mul, half, bpms[1:-1]), map(mul, bpms[2:], half))
+    middle = map(add, map(mul, half, left), map(mul, right, half))
+
+    softened = bpms[:1]
+    softened.extend(middle)
+    softened.extend(bpms[-1:])
+    return times[:1] + times[1:-1] + times[-1:], softened
+
+
+def resample(times, bpms, step, origin):
+    """
+    Linearly interpolate a series at every multiple of `step` seconds from `origin` that falls
+    within it, so series from different sessions line up point for point.  Returns the number of
+    steps from `origin` to the first of those times, and the bpm at each of them.
+    """
+    first = math.ceil((times[0] - origin) / step)
+    last = math.floor((times[-1] - origin) / step)
+    if last < first:
+        return first, []
+    if len(times) == 1:
+        return first, [bpms[0]]
+
+    grid = list(map(add, repeat(origin), map(mul, range(first, last + 1), repeat(step))))
+
+    # The points either side of each grid time.
+    after = list(map(min, map(max, map(bisect_left, repeat(times), grid), repeat(1)), repeat(len(times) - 1)))
+    before = list(map(sub, after, repeat(1)))
+    before_times = list(map(times.__getitem__, before))
+    before_bpms = list(map(bpms.__getitem__, before))
+
+    spans = map(max, map(sub, map(times.__getitem__, after), before_times), repeat(1e-9))
+    fractions = map(truediv, map(sub, grid, before_times), spans)
+    rises = map(sub, map(bpms.__getitem__, after), before_bpms)
+    return first, list(map(add, before_bpms, map(mul, rises, fractions)))
+
+
+def summarize(session):
+    """
+    Derive everything the log viewer shows for a session, in data space (seconds and bpm) so it
+    doesn't depend on the window size.  The session should already be in the results phase.
+    """
+    log = session.log
+    summary = {
+        "date" : session.date,
+        "start_time" : session.start_time,
+        "resting_bpm" : session.resting_bpm,
+        "target_low" : session.config.target_bpm_low,
+        "target_high" : session.config.target_bpm_high,
+        "rows" : len(log),
+    }
+    if len(log) == 0:
+        return summary
+
+    times = log.time
+    bpms = log.bpm
+    averages = log.bpm_rolling_average
+
+    summary["min_time"] = times[0]
+    summary["max_time"] = times[-1]
+
+    # Same rules as `workout.find_bpm_min_max`, before the margin is added.
+    summary["bpm_low"] = min(
+        compress(map(min, bpms, averages), map(gt, averages, map(mul, bpms, repeat(.5)))),
+        default=math.inf)
+    summary["bpm_high"] = max(max(bpms), max(averages))
+
+    # The time and new phase of every row where the phase changes, starting from the first row.
+    phases = log.phase
+    changes = compress(range(1, len(log)), map(ne, phases[1:], phases))
+    summary["phases"] = [[times[0], phases[0]]] + [[times[i], phases[i]] for i in changes]
+
+    # Each series is stored as a list of times and a list of bpm.
+    peaks = find_peaks(*dedupe(times, bpms))
+    peak_mins, peak_maxs = pare(*peaks)
+    for i in range(1):
+        peak_mins = pare(*peak_mins)[0]
+        peak_maxs = pare(*peak_maxs)[1]
+
+    summary["peaks"] = peaks
+    summary["peak_mins"] = peak_mins
+    summary["peak_maxs"] = peak_maxs
+
+    first, average = resample(times, averages, AVERAGE_STEP, times[0])
+    average_times = map(mul, range(first, first + len(average)), repeat(AVERAGE_STEP))
+    summary["average"] = [list(map(add, repeat(times[0]), average_times)), average]
+    return summary
+
+
+def summarize_log(path, store=None):
+    """
+    Replay a log and summarize it, returning the index entry for it.
+    """
+    stat = os.stat(path)
+    session = ReplaySession(path, store=store, columns=GRAPH_COLUMNS)
+    session.set_phase(Phase.RESULTS)
+    summary = summarize(session)
+    session.close()
+    return {
+        "mtime" : stat.st_mtime,
+        "size" : stat.st_size,
+        "summary" : summary,
+    }
+
+
+# Each worker process opens its own connection to the session store, if there is one.
+_worker_store = None
+
+
+def _init_worker(store_path):
+    global _worker_store
+    if store_path is not None:
+        _worker_store = SessionStore(store_path)
+
+
+def _summarize_in_worker(path):
+    return path, summarize_log(path, _worker_store)
+
+
+class SessionSummary:
+    """
+    The precomputed results for one log, as stored in the index.  The raw bpm series are only
+    needed by some of the viewer's modes, so they are read back out of the log when asked for.
+    """
+
+    def __init__(self, path, summary, store=None):
+        self.path = path
+        self.store = store
+        self.summary = summary
+
+        self.date = summary["date"]
+        self.start_time = summary["start_time"]
+        self.resting_bpm = summary["resting_bpm"]
+        self.target_bpm_low = summary["target_low"]
+        self.target_bpm_high = summary["target_high"]
+        self.rows = summary["rows"]
+
+        if self.rows > 0:
+            self.min_time = summary["min_time"]
+            self.max_time = summary["max_time"]
+            self.bpm_low = summary["bpm_low"]
+            self.bpm_high = summary["bpm_high"]
+            self.phases = [(t, Phase(phase)) for t, phase in summary["phases"]]
+            self.peaks = summary["peaks"]
+            self.peak_mins = summary["peak_mins"]
+            self.peak_maxs = summary["peak_maxs"]
+            self.average = summary["average"]
+
+        # Resampled series, keyed by the phase they are aligned on and the step.
+        self.aligned_cache = {}
+
+    def phase_start(self, phase):
+        """
+        The time the session first entered `phase`, or None if it never did.
+        """
+        for t, entered in self.phases:
+            if entered == phase:
+                return t
+        return None
+
+    def aligned(self, phase, step):
+        """
+        Every one of the `SERIES` resampled every `step` seconds from the start of `phase`, keyed
+        by name, as returned by `resample`.  None if the session has no such phase.
+        """
+        key = (phase, step)
+        if key not in self.aligned_cache:
+            origin = self.phase_start(phase) if self.rows > 0 else None
+            if origin is None:
+                self.aligned_cache[key] = None
+            else:
+                self.aligned_cache[key] = {
+                    name : resample(*getattr(self, name), step, origin) for name in SERIES}
+        return self.aligned_cache[key]
+
+    def octaves(self):
+        """
+        Successively smoother copies of the peaks.  These are cheap to derive and only one of the
+        viewer's modes uses them, so they aren't stored in the index.
+        """
+        octaves = []
+        softened = self.peaks
+        for i in range(5):
+            softened = soften(*softened)
+            octaves.append(softened)
+        return octaves
+
+    def load_log(self):
+        # Views can be built on the viewer's prefetch thread, which needs its own connection.
+        store = SessionStore(self.store.path) if self.store is not None else None
+        session = ReplaySession(self.path, store=store, columns=VIEW_COLUMNS)
+        session.set_phase(Phase.RESULTS)
+        if store is not None:
+            store.close()
+        return session.log
+
+
+class LogIndex:
+    """
+    An on-disk cache of `summarize` results keyed by log path, so the viewer only has to read the
+    logs that are new or have changed since it last ran.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+        try:
+            with open(path, "r") as infile:
+                blob = json.loads(infile.read())
+            if blob.get("version") == INDEX_VERSION:
+                self.entries = blob["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            # a missing or unreadable index is just rebuilt
+            pass
+
+    def fresh(self, log_path):
+        """
+        True if the index has an entry for the log that is still up to date.
+        """
+        entry = self.entries.get(os.path.abspath(log_path))
+        if entry is None:
+            return False
+        stat = os.stat(log_path)
+        return entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+
+    def update(self, log_paths, store=None, workers=None):
+        """
+        Summarize every log in `log_paths` that is new or has changed.  The work is spread over
+        `workers` processes, or one per core if that is None.  Returns the number of logs that
+        were summarized.
+        """
+        stale = [path for path in log_paths if not self.fresh(path)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(stale))
+
+        if workers <= 1:
+            for path in stale:
+                self.entries[os.path.abspath(path)] = summarize_log(path, store)
+        else:
+            ctx = multiprocessing.get_context('spawn')
+            store_path = store.path if store is not None else None
+            with ctx.Pool(workers, _init_worker, (store_path,)) as pool:
+                for path, entry in pool.imap_unordered(_summarize_in_worker, stale):
+                    self.entries[os.path.abspath(path)] = entry
+
+        if stale:
+            self.dirty = True
+        return len(stale)
+
+    def lookup(self, log_path, store=None):
+        """
+        Returns the summary for a log, deriving it again if the file changed since it was indexed.
+        """
+        self.update([log_path], store, workers=1)
+        return SessionSummary(log_path, self.entries[os.path.abspath(log_path)]["summary"], store)
+
+    def save(self, log_paths=None):
+        """
+        Write the index back out if anything changed.  If `log_paths` is given, entries for any
+        other logs are dropped.
+        """
+        if log_paths is not None:
+            keep = set(os.path.abspath(path) for path in log_paths)
+            for key in list(self.entries):
+                if key not in keep:
+                    del self.entries[key]
+                    self.dirty = True
+
+        if self.dirty:
+            blob = {
+                "version" : INDEX_VERSION,
+                "entries" : self.entries,
+            }
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as out_file:
+                out_file.write(json.dumps(blob))
+            os.replace(temp_path, self.path)
+            self.dirty = False
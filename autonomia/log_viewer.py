@@ -1,200 +1,207 @@
 
-import copy
+import math
+import queue
+import datetime
+import threading
+import collections
+from bisect import bisect_right
+from itertools import repeat, compress
+from operator import add, sub, mul, ne, itemgetter
 import pygame
-from session import Phase, Event
+from session import Phase
 from misc import zero_pad, lerp, pretty_time
 
 
-class ResultsGraph:
-    def __init__(self, session, gui, bpm_stats, global_bpm):
-        self.session = session
-
-        try:
-            self.min_time = session.log[0].time
-            self.max_time = session.log[-1].time
-            self.time_span = self.max_time - self.min_time
-        except:
-            print(session.date, session.start_time)
-            print(session, session.log)
-            raise
-
-        self.bpm_line = []
-        self.weighted_bpm_line = []
-        self.phase_lines = []
+# A short name for each of the modes `ResultsGraph` can draw, in order.
+MODE_NAMES = ("raw", "unfiltered", "average", "peaks", "envelope", "bezier")
+
+
+def phase_line_color(phase):
+    if phase == Phase.CALIBRATION:
+        return "blue"
+    if phase == Phase.STEADY:
+        return "green"
+    if phase == Phase.COOLDOWN:
+        return "red"
+    if phase == Phase.FULLSTOP:
+        return "dark red"
+    return (64, 64, 64)
+
+
+def decimate(points):
+    """
+    Reduce a line that has already been mapped to the screen to at most four points per pixel
+    column: the first, lowest, highest and last points that land in it, in their original order.
+    A line drawn through what's left covers the same pixels as one drawn through everything.
+    """
+    columns = list(map(int, map(itemgetter(0), points)))
+    starts = [0] + list(compress(range(1, len(columns)), map(ne, columns[1:], columns)))
+    stops = starts[1:] + [len(columns)]
+    y_plot = list(map(itemgetter(1), points))
+
+    reduced = []
+    for start, stop in zip(starts, stops):
+        if stop - start <= 4:
+            reduced.extend(points[start:stop])
+        else:
+            low = min(range(start, stop), key=y_plot.__getitem__)
+            high = max(range(start, stop), key=y_plot.__getitem__)
+            for index in sorted(set((start, low, high, stop - 1))):
+                reduced.append(points[index])
+    return reduced
 
-        self.last_phase = 0
 
-        self.margin_x1 = 100
-        self.margin_x2 = gui.w - 50
-        self.margin_y1 = 50
-        self.margin_y2 = gui.h - 100
+class ResultsGraph:
+    """
+    Maps a `SessionSummary` from data space onto the screen.
+    """
 
-        self.outline_line = [
-            (self.margin_x1, self.margin_y1),
-            (self.margin_x2, self.margin_y1),
-            (self.margin_x2, self.margin_y2),
-            (self.margin_x1, self.margin_y2)]
+    def __init__(self, summary, gui, bpm_stats, global_bpm):
+        self.summary = summary
 
-        phase_start = session.log[0]
-        for event in session.log:
-            phase_start = event
-            break
+        self.min_time = summary.min_time
+        self.max_time = summary.max_time
+        self.time_span = self.max_time - self.min_time
 
-        self.phases = [(0, phase_start.phase)]
+        self.set_margins(gui)
 
-        for event in session.log:
-            if event.phase != phase_start.phase:
-                self.phases.append((event.time - self.min_time, event.phase))
-                phase_start = event
+        self.phases = [(t - self.min_time, phase) for t, phase in summary.phases]
+        self.phase_times = [t for t, phase in self.phases]
 
         self.bpm_min, self.bpm_max, self.bpm_range = bpm_stats
 
-        self.x_range = abs(self.margin_x2 - self.margin_x1)
-        self.y_range = abs(self.margin_y2 - self.margin_y1)
-
         self.bpm_x_scale = 1 / self.time_span * self.x_range
         self.bpm_y_scale = 1 / self.bpm_range * self.y_range
 
-        self.target_bpm_low = session.resting_bpm + session.config.target_bpm_low
-        self.target_bpm_high = session.resting_bpm + session.config.target_bpm_high
+        self.target_bpm_low = summary.resting_bpm + summary.target_bpm_low
+        self.target_bpm_high = summary.resting_bpm + summary.target_bpm_high
 
         self.bpm_lines = []
         for i in range(-100, 100, 5):
             if global_bpm:
                 bpm = math.floor(self.bpm_min + self.bpm_range * .5) + i
             else:
-                bpm = session.resting_bpm + i
+                bpm = summary.resting_bpm + i
             if bpm >= self.bpm_min + 2 and bpm <= self.bpm_max - 2:
                 y_plot = self.margin_y2 - (bpm - self.bpm_min) * self.bpm_y_scale
                 self.bpm_lines.append((bpm, [(self.margin_x1, y_plot), (self.margin_x2, y_plot)]))
 
-        self.dedupe = [copy.copy(session.log[0])]
-
-        last = self.dedupe[-1]
-        for event in session.log[1:]:
-            if event.bpm != last.bpm:
-                self.dedupe[-1].time = (self.dedupe[-1].time + last.time) * .5
-                self.dedupe.append(copy.copy(event))
-            last = copy.copy(event)
-        if self.dedupe[-1] is not last:
-            self.dedupe.append(last)
-
-        self.peaks = [self.dedupe[0]]
-        for i in range(1, len(self.dedupe) - 1):
-            a = self.dedupe[i - 1]
-            b = self.dedupe[i]
-            c = self.dedupe[i + 1]
-            if (a.bpm < b.bpm and c.bpm < b.bpm) or (a.bpm > b.bpm and c.bpm > b.bpm):
-                self.peaks.append(b)
-        if self.peaks[-1] is not self.dedupe[-1]:
-            self.peaks.append(self.dedupe[-1])
-
-        self.peak_lines = []
-        for event in self.peaks:
-            x_plot = self.margin_x1 + (event.time - self.min_time) * self.bpm_x_scale
-            y_plot = self.margin_y2 - (event.bpm - self.bpm_min) * self.bpm_y_scale
-            self.peak_lines.append((x_plot, y_plot))
-
-        def pare(events, span=1):
-            min_list = []
-            max_list = []
-            for i in range(len(events)):
-                low = max(0, i - span)
-                high = max(0, i + span + 1)
-                neighbors = list([e.bpm for e in events[low:high]])
-                if events[i].bpm == min(neighbors):
-                    min_list.append(events[i])
-                if events[i].bpm == max(neighbors):
-                    max_list.append(events[i])
-            return min_list, max_list
-
-        self.peak_mins, self.peak_maxs = pare(self.peaks)
-        for i in range(1):
-            self.peak_mins = pare(self.peak_mins)[0]
-            self.peak_maxs = pare(self.peak_maxs)[1]
-
-        self.peak_min_lines = []
-        for event in self.peak_mins:
-            x_plot = self.margin_x1 + (event.time - self.min_time) * self.bpm_x_scale
-            y_plot = self.margin_y2 - (event.bpm - self.bpm_min) * self.bpm_y_scale
-            self.peak_min_lines.append((x_plot, y_plot))
-
-        self.peak_max_lines = []
-        for event in self.peak_maxs:
-            x_plot = self.margin_x1 + (event.time - self.min_time) * self.bpm_x_scale
-            y_plot = self.margin_y2 - (event.bpm - self.bpm_min) * self.bpm_y_scale
-            self.peak_max_lines.append((x_plot, y_plot))
-
-        def soften(events):
-            reduced = [copy.copy(events[0])]
-            for i in range(1, len(events) - 1):
-                a = events[i - 1]
-                b = events[i]
-                c = events[i + 1]
-
-                bpm = lerp(lerp(a.bpm, b.bpm, .5), lerp(b.bpm, c.bpm, .5), .5)
-                b = copy.copy(b)
-                b.bpm = bpm
-
-                reduced.append(b)
-            reduced.append(copy.copy(events[-1]))
-            return reduced
-
-        self.octaves = []
-        softened = self.peaks
-        for i in range(5):
-            softened = soften(softened)
-            octave = []
-            for event in softened:
-                x_plot = self.margin_x1 + (event.time - self.min_time) * self.bpm_x_scale
-                y_plot = self.margin_y2 - (event.bpm - self.bpm_min) * self.bpm_y_scale
-                octave.append((x_plot, y_plot))
-            self.octaves.append(octave)
-
-        for event in session.log:
-            x_plot = self.margin_x1 + (event.time - self.min_time) * self.bpm_x_scale
-            y_plot = self.margin_y2 - (event.bpm - self.bpm_min) * self.bpm_y_scale
-            self.bpm_line.append((x_plot, y_plot))
-
-            y_plot = self.margin_y2 - (event.bpm_rolling_average - self.bpm_min) * self.bpm_y_scale
-            self.weighted_bpm_line.append((x_plot, y_plot))
-
-            if event.phase != self.last_phase:
-                self.last_phase = event.phase
-                phase_color = (64, 64, 64)
-                if event.phase == Phase.CALIBRATION:
-                    phase_color = "blue"
-                if event.phase == Phase.STEADY:
-                    phase_color = "green"
-                if event.phase == Phase.COOLDOWN:
-                    phase_color = "red"
-                if event.phase == Phase.FULLSTOP:
-                    phase_color = "dark red"
+        self.peak_lines = self.plot(summary.peaks)
+        self.peak_min_lines = self.plot(summary.peak_mins)
+        self.peak_max_lines = self.plot(summary.peak_maxs)
+
+        # A phase line is drawn wherever the phase changes, including at the very start of the
+        # log unless it begins in the resting phase.
+        self.phase_lines = []
+        for index, (t, phase) in enumerate(summary.phases):
+            if index > 0 or phase != Phase.RESTING_BPM:
+                x_plot = self.margin_x1 + (t - self.min_time) * self.bpm_x_scale
                 self.phase_lines.append(
-                    (phase_color, [(x_plot, self.margin_y1), (x_plot, self.margin_y2)]))
+                    (phase_line_color(phase), [(x_plot, self.margin_y1), (x_plot, self.margin_y2)]))
+
+        # The raw series are only read from the log when a mode that shows them is selected.
+        self.log = None
+        self.bpm_line = None
+        self.weighted_bpm_line = None
+        self.octaves = None
+
+        self.static = None
+        self.static_mode = None
+        self.on_screen = False
+        self.hover_rects = []
+
+    def set_margins(self, gui):
+        """
+        Lay out the graph's area within the window.
+        """
+        self.margin_x1 = 100
+        self.margin_x2 = gui.w - 50
+        self.margin_y1 = 50
+        self.margin_y2 = gui.h - 100
 
+        self.outline_line = [
+            (self.margin_x1, self.margin_y1),
+            (self.margin_x2, self.margin_y1),
+            (self.margin_x2, self.margin_y2),
+            (self.margin_x1, self.margin_y2)]
 
-    def __call__(self, gui, current_mode = 0):
-        session = self.session
-        gui.clear((90, 90, 90))
+        self.x_range = abs(self.margin_x2 - self.margin_x1)
+        self.y_range = abs(self.margin_y2 - self.margin_y1)
 
-        resting_bpm_y = self.margin_y2 - (session.resting_bpm - self.bpm_min) * self.bpm_y_scale
+    def plot(self, series):
+        """
+        Map a series stored as a list of times and a list of bpm onto the screen.
+        """
+        return self.plot_columns(*series)
+
+    def plot_columns(self, times, bpms):
+        """
+        Map a column of times and a column of bpm onto the screen.
+        """
+        x_offsets = map(mul, map(sub, times, repeat(self.min_time)), repeat(self.bpm_x_scale))
+        y_offsets = map(mul, map(sub, bpms, repeat(self.bpm_min)), repeat(self.bpm_y_scale))
+        x_plot = map(add, repeat(self.margin_x1), x_offsets)
+        y_plot = map(sub, repeat(self.margin_y2), y_offsets)
+        points = list(zip(x_plot, y_plot))
+
+        # Long sessions have far more points than the graph has pixels across, so they are
+        # thinned out here once instead of making every frame draw all of them.
+        if len(points) > 4 * self.x_range:
+            points = decimate(points)
+        return points
+
+    def load_log(self):
+        """
+        Read the session's events back in for the raw series and the hover readout.  The time
+        column doubles as the index for looking events up by time.
+        """
+        if self.log is None:
+            self.log = self.summary.load_log()
+        return self.log
+
+    def load_raw_lines(self):
+        # The prefetch thread may be doing the same, so the line that is checked is set last.
+        if self.weighted_bpm_line is None:
+            log = self.load_log()
+            self.bpm_line = self.plot_columns(log.time, log.bpm)
+            self.weighted_bpm_line = self.plot_columns(log.time, log.bpm_rolling_average)
+
+    def event_at(self, t):
+        """
+        The event closest to `t` seconds into the session, found by bisecting the time column.
+        """
+        log = self.load_log()
+        times = log.time
+        t += self.min_time
+        index = bisect_right(times, t)
+        if index == len(times) or (index > 0 and t - times[index - 1] <= times[index] - t):
+            index -= 1
+        return log[index]
+
+    def load_octaves(self):
+        if self.octaves is None:
+            self.octaves = [self.plot(octave) for octave in self.summary.octaves()]
+
+    def draw_static(self, gui, surface, current_mode):
+        """
+        Draw everything in the view that doesn't follow the mouse.
+        """
+        summary = self.summary
+        surface.fill((90, 90, 90))
+
+        resting_bpm_y = self.margin_y2 - (summary.resting_bpm - self.bpm_min) * self.bpm_y_scale
         target_low_y = self.margin_y2 - (self.target_bpm_low - self.bpm_min) * self.bpm_y_scale
         target_high_y = self.margin_y2 - (self.target_bpm_high - self.bpm_min) * self.bpm_y_scale
 
-        mouse_x, mouse_y = pygame.mouse.get_pos()
-        hover_x = mouse_x >= self.margin_x1 and mouse_x <= self.margin_x2
-        hover_y = mouse_y >= self.margin_y1 and mouse_y <= self.margin_y2
-
         pygame.draw.polygon(
-            gui.screen, (96, 96, 96),
+            surface, (96, 96, 96),
             [(self.margin_x1, self.margin_y1),
              (self.margin_x1, self.margin_y2),
              (self.margin_x2, self.margin_y2),
              (self.margin_x2, self.margin_y1)])
 
         pygame.draw.polygon(
-            gui.screen, (80, 80, 80),
+            surface, (80, 80, 80),
             [(self.margin_x1, target_low_y),
              (self.margin_x1, target_high_y),
              (self.margin_x2, target_high_y),
@@ -202,112 +209,394 @@ class ResultsGraph:
 
         if current_mode == 4 or current_mode == 5:
             pygame.draw.polygon(
-                gui.screen, (100, 100, 100),
+                surface, (100, 100, 100),
                 self.peak_min_lines + [i for i in reversed(self.peak_max_lines)])
 
         for phase_color, phase_line in self.phase_lines:
-            pygame.draw.lines(gui.screen, phase_color, False, phase_line, 2)
+            pygame.draw.lines(surface, phase_color, False, phase_line, 2)
 
         for bpm, line in self.bpm_lines:
             label_color = "gray"
-            if bpm == self.session.resting_bpm:
+            if bpm == summary.resting_bpm:
                 label_color = "blue"
             if bpm == self.target_bpm_low or bpm == self.target_bpm_high:
                 label_color = "white"
-            pygame.draw.lines(gui.screen, "gray", False, line, 1)
-            gui.draw_y_label(int(bpm), line[0][0] - 5, line[0][1], label_color)
+            pygame.draw.lines(surface, "gray", False, line, 1)
+            gui.draw_y_label(int(bpm), line[0][0] - 5, line[0][1], label_color, target=surface)
 
         pygame.draw.lines(
-            gui.screen, "blue", False,
+            surface, "blue", False,
             [(self.margin_x1, resting_bpm_y),
              (self.margin_x2, resting_bpm_y)], 2)
 
         pygame.draw.lines(
-            gui.screen, "black", False,
+            surface, "black", False,
             [(self.margin_x1, target_low_y),
              (self.margin_x2, target_low_y)], 2)
 
         pygame.draw.lines(
-            gui.screen, "black", False,
+            surface, "black", False,
             [(self.margin_x1, target_high_y),
              (self.margin_x2, target_high_y)], 2)
 
-        if hover_x:
-            pygame.draw.lines(
-                gui.screen, "magenta", False,
-                [(mouse_x, self.margin_y1),
-                 (mouse_x, self.margin_y2)], 1)
-            x_span_px = self.margin_x2 - self.margin_x1
-            a = (mouse_x - self.margin_x1) / x_span_px
-            hover_t = lerp(0, self.max_time - self.min_time, a)
-            anchor = (gui.h - self.margin_y2) * .5 + self.margin_y2
-
-            gui.draw_x_label(pretty_time(hover_t), mouse_x, anchor, "magenta", y_align=1)
-
-            selected_phase = None
-            for time, phase in self.phases:
-                if hover_t >= time:
-                    selected_phase = str(phase._name_).lower()
-                else:
-                    break
-            if selected_phase is not None:
-                gui.draw_x_label(selected_phase, mouse_x, anchor, "gray", y_align=0)
-
-        if hover_y:
-            pygame.draw.lines(
-                gui.screen, "magenta", False,
-                [(self.margin_x1, mouse_y),
-                 (self.margin_x2, mouse_y)], 1)
-            y_span_px = self.margin_y2 - self.margin_y1
-            a = (mouse_y - self.margin_y1) / y_span_px
-            hover_bpm = round(lerp(self.bpm_max, self.bpm_min, a))
-            gui.draw_y_label(hover_bpm, self.margin_x1 - 5, mouse_y, "magenta")
+        if current_mode <= 2:
+            self.load_raw_lines()
+        elif current_mode == 5:
+            self.load_octaves()
 
         if current_mode == 0:
             gui.draw_text(
                 "unfiltered bpm & rolling average",
-                self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1)
-            pygame.draw.lines(gui.screen, "dark red", False, self.bpm_line, 1)
-            pygame.draw.lines(gui.screen, "white", False, self.weighted_bpm_line, 1)
+                self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1, target=surface)
+            pygame.draw.lines(surface, "dark red", False, self.bpm_line, 1)
+            pygame.draw.lines(surface, "white", False, self.weighted_bpm_line, 1)
 
         elif current_mode == 1:
             gui.draw_text(
-                "unfiltered bpm", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1)
-            pygame.draw.lines(gui.screen, "white", False, self.bpm_line, 1)
+                "unfiltered bpm", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1,
+                target=surface)
+            pygame.draw.lines(surface, "white", False, self.bpm_line, 1)
 
         elif current_mode == 2:
             gui.draw_text(
-                "bpm rolling average", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1)
-            pygame.draw.lines(gui.screen, "white", False, self.weighted_bpm_line, 1)
+                "bpm rolling average", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1,
+                target=surface)
+            pygame.draw.lines(surface, "white", False, self.weighted_bpm_line, 1)
 
         elif current_mode == 3:
             gui.draw_text(
-                "bpm peaks", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1)
-            pygame.draw.lines(gui.screen, "white", False, self.peak_lines, 1)
+                "bpm peaks", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1,
+                target=surface)
+            pygame.draw.lines(surface, "white", False, self.peak_lines, 1)
 
         elif current_mode == 4:
             gui.draw_text(
-                "bpm envelope", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1)
+                "bpm envelope", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1,
+                target=surface)
             outline_color = (50, 50, 50)
-            pygame.draw.lines(gui.screen, outline_color, False, self.peak_min_lines, 4)
-            pygame.draw.lines(gui.screen, outline_color, False, self.peak_max_lines, 4)
-            pygame.draw.lines(gui.screen, "white", False, self.peak_lines, 1)
+            pygame.draw.lines(surface, outline_color, False, self.peak_min_lines, 4)
+            pygame.draw.lines(surface, outline_color, False, self.peak_max_lines, 4)
+            pygame.draw.lines(surface, "white", False, self.peak_lines, 1)
 
         elif current_mode == 5:
             gui.draw_text(
-                "bpm envelope & bezier", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1)
-            pygame.draw.lines(gui.screen, "black", False, self.peak_min_lines, 4)
-            pygame.draw.lines(gui.screen, "black", False, self.peak_max_lines, 4)
-            pygame.draw.lines(gui.screen, "white", False, self.peak_lines, 1)
+                "bpm envelope & bezier", self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1,
+                target=surface)
+            pygame.draw.lines(surface, "black", False, self.peak_min_lines, 4)
+            pygame.draw.lines(surface, "black", False, self.peak_max_lines, 4)
+            pygame.draw.lines(surface, "white", False, self.peak_lines, 1)
             for i, octave in enumerate(self.octaves):
                 a = (i + 1) / max(len(self.octaves), 1)
                 c = lerp(64, 0, a)
                 color = (c, c, c)
                 thickness = round(lerp(2, 6, a))
-                pygame.draw.lines(gui.screen, color, False, octave, thickness)
+                pygame.draw.lines(surface, color, False, octave, thickness)
 
         target_bpm = (
-            session.resting_bpm + session.config.target_bpm_low,
-            session.resting_bpm + session.config.target_bpm_high)
+            summary.resting_bpm + summary.target_bpm_low,
+            summary.resting_bpm + summary.target_bpm_high)
+
+        pygame.draw.lines(surface, "black", True, self.outline_line, 2)
+
+        date_label = summary.date.replace("_", ".")
+        weekday = datetime.datetime.strptime(summary.date, "%Y_%m_%d").strftime("%A")
+        parts = [date_label, weekday]
+        if summary.start_time:
+            parts.append(summary.start_time)
+        date_label = "    ".join(parts)
+        gui.draw_text(date_label, self.margin_x1, self.margin_y1, font="smol", y_align=1, target=surface)
+
+    def draw_hover(self, gui):
+        """
+        Draw the crosshair and readouts that follow the mouse.  Returns the areas of the screen
+        that were drawn over.
+        """
+        dirty = []
+        mouse_x, mouse_y = pygame.mouse.get_pos()
+        hover_x = mouse_x >= self.margin_x1 and mouse_x <= self.margin_x2
+        hover_y = mouse_y >= self.margin_y1 and mouse_y <= self.margin_y2
+
+        if hover_x:
+            dirty.append(pygame.draw.lines(
+                gui.screen, "magenta", False,
+                [(mouse_x, self.margin_y1),
+                 (mouse_x, self.margin_y2)], 1))
+            x_span_px = self.margin_x2 - self.margin_x1
+            a = (mouse_x - self.margin_x1) / x_span_px
+            hover_t = lerp(0, self.max_time - self.min_time, a)
+            anchor = (gui.h - self.margin_y2) * .5 + self.margin_y2
+
+            dirty.append(gui.draw_x_label(pretty_time(hover_t), mouse_x, anchor, "magenta", y_align=1))
+
+            selected_phase = bisect_right(self.phase_times, hover_t) - 1
+            if selected_phase >= 0:
+                phase_name = str(self.phases[selected_phase][1]._name_).lower()
+                dirty.append(gui.draw_x_label(phase_name, mouse_x, anchor, "gray", y_align=0))
+
+            event = self.event_at(hover_t)
+            readout = "    ".join([
+                f"bpm {round(event.bpm)}",
+                f"average {event.bpm_rolling_average:.1f}",
+                f"cadence {event.cadence}",
+                f"watts {event.watts}",
+                f"rr {round(event.rr_interval)} ms"])
+            if mouse_x < (self.margin_x1 + self.margin_x2) * .5:
+                dirty.append(gui.draw_text(
+                    readout, mouse_x + 10, self.margin_y1 + 10, "magenta", font="smol"))
+            else:
+                dirty.append(gui.draw_text(
+                    readout, mouse_x - 10, self.margin_y1 + 10, "magenta", font="smol", x_align=1))
+
+        if hover_y:
+            dirty.append(pygame.draw.lines(
+                gui.screen, "magenta", False,
+                [(self.margin_x1, mouse_y),
+                 (self.margin_x2, mouse_y)], 1))
+            y_span_px = self.margin_y2 - self.margin_y1
+            a = (mouse_y - self.margin_y1) / y_span_px
+            hover_bpm = round(lerp(self.bpm_max, self.bpm_min, a))
+            dirty.append(gui.draw_y_label(hover_bpm, self.margin_x1 - 5, mouse_y, "magenta"))
+
+        return dirty
+
+    def __call__(self, gui, current_mode = 0):
+        """
+        Draw the view.  The static part is rendered off screen once per mode, so a frame is just
+        a matter of patching up where the crosshair was and drawing it again.  Returns the areas
+        of the screen that changed, or None if all of it did.
+        """
+        if self.static is None or self.static_mode != current_mode:
+            self.static = pygame.Surface((gui.w, gui.h)).convert()
+            self.static_mode = current_mode
+            self.draw_static(gui, self.static, current_mode)
+            self.hover_rects = []
+            self.on_screen = False
+
+        if self.on_screen:
+            changed = self.hover_rects
+            for rect in changed:
+                gui.screen.blit(self.static, rect, rect)
+        else:
+            changed = None
+            gui.screen.blit(self.static, (0, 0))
+            self.on_screen = True
+
+        self.hover_rects = self.draw_hover(gui)
+        if changed is not None:
+            changed = changed + self.hover_rects
+        return changed
+
+    def release(self):
+        """
+        Drop the off screen copy of the view when it's no longer being shown.
+        """
+        self.static = None
+        self.on_screen = False
+
+
+# Seconds between the points that overlaid sessions are resampled to.
+ALIGN_STEP = 5
+
+
+class OverlayGraph(ResultsGraph):
+    """
+    Several sessions drawn over each other, lined up on the start of one phase.  The most recent
+    session is drawn brightest.  The modes that show the raw series draw the rolling averages,
+    and the rest draw the peaks, with the envelope of the most recent session behind them.
+    """
+
+    def __init__(self, summaries, gui, bpm_stats, align_phase, step=ALIGN_STEP):
+        self.summaries = summaries
+        self.align_phase = align_phase
+        self.step = step
+
+        self.set_margins(gui)
+
+        self.bpm_min, self.bpm_max, self.bpm_range = bpm_stats
+
+        # Resampling is cached on the summaries, so flipping between sets only has to plot.
+        aligned = []
+        for summary in summaries:
+            series = summary.aligned(align_phase, step)
+            if series is not None and len(series["peaks"][1]) > 0:
+                aligned.append((summary, series))
+        self.aligned = aligned
+
+        extents = [
+            (start, start + len(bpms) - 1)
+            for summary, series in aligned for start, bpms in series.values() if len(bpms) > 0]
+        first = min((start for start, end in extents), default=0)
+        last = max((end for start, end in extents), default=1)
+        self.first = first
+        self.min_time = first * step
+        self.max_time = max(last, first + 1) * step
+        self.time_span = self.max_time - self.min_time
+
+        self.bpm_x_scale = 1 / self.time_span * self.x_range
+        self.bpm_y_scale = 1 / self.bpm_range * self.y_range
 
-        pygame.draw.lines(gui.screen, "black", True, self.outline_line, 2)
+        self.bpm_lines = []
+        for bpm in range(math.ceil(self.bpm_min / 10) * 10, math.floor(self.bpm_max) + 1, 10):
+            y_plot = self.margin_y2 - (bpm - self.bpm_min) * self.bpm_y_scale
+            self.bpm_lines.append((bpm, [(self.margin_x1, y_plot), (self.margin_x2, y_plot)]))
+
+        self.align_x = self.margin_x1 - self.min_time * self.bpm_x_scale
+
+        self.lines = [self.plot_aligned(*series["peaks"]) for summary, series in aligned]
+        self.average_lines = [self.plot_aligned(*series["average"]) for summary, series in aligned]
+        self.envelope = []
+        if aligned:
+            series = aligned[-1][1]
+            self.envelope = (
+                self.plot_aligned(*series["peak_mins"]) +
+                list(reversed(self.plot_aligned(*series["peak_maxs"]))))
+
+        self.static = None
+        self.static_mode = None
+        self.on_screen = False
+        self.hover_rects = []
+
+    def plot_aligned(self, start, bpms):
+        """
+        Map a resampled series onto the screen.
+        """
+        x_offsets = map(mul, range(start - self.first, start - self.first + len(bpms)), repeat(self.step * self.bpm_x_scale))
+        y_offsets = map(mul, map(sub, bpms, repeat(self.bpm_min)), repeat(self.bpm_y_scale))
+        points = list(zip(map(add, repeat(self.margin_x1), x_offsets), map(sub, repeat(self.margin_y2), y_offsets)))
+        if len(points) > 4 * self.x_range:
+            points = decimate(points)
+        return points
+
+    def draw_static(self, gui, surface, current_mode):
+        surface.fill((90, 90, 90))
+
+        pygame.draw.polygon(
+            surface, (96, 96, 96),
+            [(self.margin_x1, self.margin_y1),
+             (self.margin_x1, self.margin_y2),
+             (self.margin_x2, self.margin_y2),
+             (self.margin_x2, self.margin_y1)])
+
+        if (current_mode == 4 or current_mode == 5) and len(self.envelope) > 2:
+            pygame.draw.polygon(surface, (100, 100, 100), self.envelope)
+
+        for bpm, line in self.bpm_lines:
+            pygame.draw.lines(surface, "gray", False, line, 1)
+            gui.draw_y_label(int(bpm), line[0][0] - 5, line[0][1], "gray", target=surface)
+
+        pygame.draw.lines(
+            surface, phase_line_color(self.align_phase), False,
+            [(self.align_x, self.margin_y1), (self.align_x, self.margin_y2)], 2)
+
+        lines = self.average_lines if current_mode <= 2 else self.lines
+        for i, line in enumerate(lines):
+            if len(line) < 2:
+                continue
+            a = (i + 1) / len(lines)
+            c = lerp(48, 255, a * a)
+            pygame.draw.lines(surface, (c, c, c), False, line, 2 if i == len(lines) - 1 else 1)
+
+        pygame.draw.lines(surface, "black", True, self.outline_line, 2)
+
+        phase_name = str(self.align_phase._name_).lower()
+        gui.draw_text(
+            f"{len(self.aligned)} sessions aligned on {phase_name}",
+            self.margin_x2, self.margin_y1, font="smol", x_align=1, y_align=1, target=surface)
+
+        if self.aligned:
+            dates = [summary.date.replace("_", ".") for summary, series in self.aligned]
+            date_label = f"{dates[0]} - {dates[-1]}"
+        else:
+            date_label = f"no sessions with a {phase_name} phase"
+        gui.draw_text(date_label, self.margin_x1, self.margin_y1, font="smol", y_align=1, target=surface)
+
+    def draw_hover(self, gui):
+        dirty = []
+        mouse_x, mouse_y = pygame.mouse.get_pos()
+        hover_x = mouse_x >= self.margin_x1 and mouse_x <= self.margin_x2
+        hover_y = mouse_y >= self.margin_y1 and mouse_y <= self.margin_y2
+
+        if hover_x:
+            dirty.append(pygame.draw.lines(
+                gui.screen, "magenta", False,
+                [(mouse_x, self.margin_y1),
+                 (mouse_x, self.margin_y2)], 1))
+            hover_t = self.min_time + (mouse_x - self.margin_x1) / self.bpm_x_scale
+            label = pretty_time(int(abs(hover_t)))
+            if hover_t < 0:
+                label = "-" + label
+            anchor = (gui.h - self.margin_y2) * .5 + self.margin_y2
+            dirty.append(gui.draw_x_label(label, mouse_x, anchor, "magenta", y_align=1))
+
+        if hover_y:
+            dirty.append(pygame.draw.lines(
+                gui.screen, "magenta", False,
+                [(self.margin_x1, mouse_y),
+                 (self.margin_x2, mouse_y)], 1))
+            a = (mouse_y - self.margin_y1) / (self.margin_y2 - self.margin_y1)
+            hover_bpm = round(lerp(self.bpm_max, self.bpm_min, a))
+            dirty.append(gui.draw_y_label(hover_bpm, self.margin_x1 - 5, mouse_y, "magenta"))
+
+        return dirty
+
+
+class ViewCache:
+    """
+    Builds `ResultsGraph` views the first time they are shown and keeps only the most recently
+    used `capacity` of them.  A background thread builds the views the user is likely to look at
+    next, so moving between sessions doesn't have to wait on them.
+    """
+
+    def __init__(self, build, capacity=9):
+        self.build = build
+        self.capacity = capacity
+        self.views = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.prefetch_runner, daemon=True)
+        self.worker.start()
+
+    def cached(self, index):
+        with self.lock:
+            view = self.views.get(index)
+            if view is not None:
+                self.views.move_to_end(index)
+            return view
+
+    def store(self, index, view):
+        with self.lock:
+            view = self.views.setdefault(index, view)
+            self.views.move_to_end(index)
+            while len(self.views) > self.capacity:
+                self.views.popitem(last=False)
+            return view
+
+    def get(self, index, current_mode):
+        view = self.cached(index)
+        if view is None:
+            view = self.store(index, self.build(index))
+        if current_mode <= 2:
+            view.load_raw_lines()
+        return view
+
+    def prefetch(self, indices, current_mode):
+        """
+        Queue up views to be built in the background, most wanted first.  Requests that are still
+        waiting from earlier calls are dropped, since the user has moved on from them.
+        """
+        try:
+            while True:
+                self.requests.get_nowait()
+        except queue.Empty:
+            pass
+        for index in indices[:self.capacity - 1]:
+            self.requests.put((index, current_mode))
+
+    def prefetch_runner(self):
+        while True:
+            index, current_mode = self.requests.get()
+            if self.cached(index) is None:
+                view = self.store(index, self.build(index))
+                if current_mode <= 2:
+                    view.load_raw_lines()
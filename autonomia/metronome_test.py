@@ -23,7 +23,7 @@ def metronome_test_main(bluetooth_addr):
         while len(pending) == 0:
             pump_events()
         interval = pending.pop(0)
-        bpm = 60_000 // interval
+        bpm = round(60_000 / interval)
         metronome.reset(bpm // metronome.meter, 1)
         print(bpm)
         time.sleep(interval / 1000)
@@ -32,7 +32,7 @@ def metronome_test_main(bluetooth_addr):
             while len(pending) == 0:
                 pump_events()
             interval = pending.pop(0)
-            bpm = 60_000 // interval
+            bpm = round(60_000 / interval)
             metronome.tweak(bpm // metronome.meter, 1)
             print(bpm)
             time.sleep(interval / 1000)
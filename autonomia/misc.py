@@ -18,3 +18,12 @@ def pretty_time(seconds):
     minutes = zero_pad(seconds // 60)
     seconds = zero_pad(seconds % 60)
     return f"{minutes}:{seconds}"
+
+
+def percentiles(samples, fractions):
+    """
+    Returns the sample at each of the fractions of the way through the sorted samples.
+    """
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+    return [ordered[round(fraction * last)] for fraction in fractions]
@@ -0,0 +1,92 @@
+import ctypes
+import struct
+
+
+# The most rr intervals a heart rate measurement notification can carry, with a one byte bpm.
+MAX_RR_INTERVALS = 9
+
+# One record per notification from the heart rate monitor: the time.monotonic() it was received
+# at, the bpm, the notification's flags, how many rr intervals it carried and the intervals, as
+# sent in units of 1/1024 s.
+RECORD = struct.Struct(f"=dHBB{MAX_RR_INTERVALS}H2x")
+
+# Milliseconds per unit of a recorded rr interval.  This is exact in binary, so the conversion
+# loses nothing.
+RR_INTERVAL_MS = 1000 / 1024
+
+
+class PulseRing:
+    """
+    A ring buffer of pulse records in shared memory, written by the bluetooth process and read by
+    the UI.  The writer fills in the next slot and then bumps the count of records written, and
+    the reader copies out everything between the last count it saw and the current one at once.
+
+    There must be only one writer and one reader.  A reader that falls a whole ring behind loses
+    the oldest records, which are counted in `dropped`.
+    """
+
+    def __init__(self, ctx, capacity=4096):
+        self.capacity = capacity
+        self.written = ctx.RawValue(ctypes.c_uint64, 0)
+        self.records = ctx.RawArray(ctypes.c_uint8, capacity * RECORD.size)
+        self.read_count = 0
+        self.dropped = 0
+
+    def buffer(self):
+        return memoryview(self.records).cast("B")
+
+    def next_slot(self):
+        """
+        Returns the buffer and offset the next record should be packed into.  It isn't visible to
+        the reader until `commit` is called.
+        """
+        return self.buffer(), (self.written.value % self.capacity) * RECORD.size
+
+    def commit(self):
+        self.written.value += 1
+
+    def write(self, received, bpm, flags, rr_intervals):
+        rr_intervals = list(rr_intervals[:MAX_RR_INTERVALS])
+        rr_count = len(rr_intervals)
+        rr_intervals.extend([0] * (MAX_RR_INTERVALS - rr_count))
+
+        buffer, offset = self.next_slot()
+        RECORD.pack_into(buffer, offset, received, bpm, flags, rr_count, *rr_intervals)
+        self.commit()
+
+    def read(self):
+        """
+        Returns every record written since the last call, packed one after another in a single
+        bytes object.
+        """
+        written = self.written.value
+        start = max(self.read_count, written - self.capacity)
+        self.dropped += start - self.read_count
+        self.read_count = written
+        if written == start:
+            return b""
+
+        view = self.buffer()
+        first = (start % self.capacity) * RECORD.size
+        last = (written % self.capacity) * RECORD.size
+        if first < last:
+            data = bytes(view[first:last])
+        else:
+            data = bytes(view[first:]) + bytes(view[:last])
+
+        # Whatever the writer got around to overwriting while this was being copied is garbage,
+        # including the slot it may be halfway through writing now.
+        lapped = min(self.written.value + 1 - self.capacity - start, written - start)
+        if lapped > 0:
+            data = data[lapped * RECORD.size:]
+            self.dropped += lapped
+        return data
+
+
+def iter_records(data):
+    """
+    Unpacks records read from a `PulseRing` into (received, bpm, flags, rr_intervals) tuples,
+    with the rr intervals in milliseconds.
+    """
+    for received, bpm, flags, rr_count, *rr_intervals in RECORD.iter_unpack(data):
+        yield received, bpm, flags, [rr_interval * RR_INTERVAL_MS for rr_interval in rr_intervals[:rr_count]]
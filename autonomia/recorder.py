@@ -0,0 +1,80 @@
+import os
+import time
+import binary_log
+from event_log import EventLog
+
+
+class Recorder:
+    """
+    Streams a live session's log to disk in the binary log format while the workout runs.
+
+    Events are written as a new block every `flush_interval` seconds and at every phase change,
+    and each write is fsync'd, so a crash or power loss costs at most the last few seconds of the
+    session.  The file is readable as a log the whole time.  Once written, events only need to
+    stay in memory for the live screens, so the session keeps a bounded tail of them.
+    """
+
+    def __init__(self, path, header, flush_interval=5, tail_length=600):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.tail_length = tail_length
+
+        self.rows = 0
+        self.blocks = 0
+        self.flushed = 0 # rows of the session's current log that are already on disk
+        self.last_flush = time.monotonic()
+
+        self.out_file = open(path, "wb")
+        self.out_file.write(binary_log.pack_header(header))
+        self.sync()
+
+    def sync(self):
+        self.out_file.flush()
+        os.fsync(self.out_file.fileno())
+
+    def due(self):
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self, log, stop=None):
+        """
+        Write out the events in `log` before `stop` that aren't on disk yet.  Events from `stop`
+        on are still being edited, and wait for the next flush.  Returns the log the session
+        should keep using, which is trimmed down to the most recent events once it grows too long.
+        """
+        self.last_flush = time.monotonic()
+        if stop is None:
+            stop = len(log)
+
+        if self.flushed < stop:
+            self.out_file.write(binary_log.pack_block(log, self.flushed, stop))
+            self.sync()
+            self.rows += stop - self.flushed
+            self.blocks += 1
+            self.flushed = stop
+
+        if len(log) > self.tail_length * 2:
+            start = min(len(log) - self.tail_length, self.flushed)
+            tail = EventLog()
+            tail.extend(log, start)
+            log = tail
+            self.flushed -= start
+
+        return log
+
+    def finish(self, log, header, path=None):
+        """
+        Write out the remaining events and the final header, then close the file.  If `path` is
+        given, the finished log is moved there.
+        """
+        log = self.flush(log)
+
+        self.out_file.seek(0)
+        self.out_file.write(binary_log.pack_header(header, self.rows, self.blocks))
+        self.sync()
+        self.out_file.close()
+
+        if path is not None and path != self.path:
+            os.replace(self.path, path)
+            self.path = path
+
+        return log
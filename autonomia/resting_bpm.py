@@ -11,11 +11,16 @@ class RestingBPM:
 
 
     def __call__(self, gui, session, event):
+        self.update(session, event)
+        self.draw(gui, session, event)
+
+    def update(self, session, event):
         if event and event.bpm > 1 and not event.error:
             self.calibration.append(event.bpm)
             if len(self.calibration) > 100:
                 self.calibration = self.calibration[-101:]
 
+    def draw(self, gui, session, event):
         gui.clear((64, 0, 128))
 
         if event and len(self.calibration) > 1:
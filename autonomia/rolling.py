@@ -0,0 +1,245 @@
+from array import array
+from collections import deque
+
+
+class RollingWindow:
+    """
+    Rolling statistics over the trailing `seconds` of a (time, value) stream.
+
+    Samples are kept in a ring buffer alongside running sums and monotonic min / max queues, so
+    pushing a sample and querying the window are both constant time no matter how long the
+    session has been going.
+
+    The window follows the conventions of the old `Session.window` helper so the rolling average
+    written to the logs doesn't change: the two log entries before the window edge are retained,
+    and the average for a new sample is taken over the previous frame with its newest sample
+    dropped.
+    """
+
+    def __init__(self, seconds, capacity=64):
+        self.seconds = seconds
+        self.capacity = capacity
+
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.repeats = array("B", bytes(capacity))
+
+        # Sequence numbers, which map onto ring slots modulo the capacity.
+        self.head = 0  # oldest retained sample
+        self.start = 0 # oldest sample inside the window
+        self.tail = 0  # one past the newest sample
+
+        self.pushed = 0
+        self.average = 0
+
+        # Running sums are taken relative to `origin`, which is periodically moved up to the
+        # oldest sample to keep the squared terms small.
+        self.origin = 0.0
+        self.rebase_at = capacity
+        self.n = 0
+        self.w1 = 0.0
+        self.w2 = 0.0
+        self.v0 = 0.0
+        self.v1 = 0.0
+        self.v2 = 0.0
+        self.total = 0.0
+
+        self.lows = deque()
+        self.highs = deque()
+
+    def __len__(self):
+        return self.tail - self.start
+
+    def push(self, t, value):
+        """
+        Add a sample and return the time weighted (exponent 2) rolling average for it.
+        """
+        n = self.n
+        w1 = self.w1
+        w2 = self.w2
+        v0 = self.v0
+        v1 = self.v1
+        v2 = self.v2
+
+        if self.pushed <= 1:
+            # Session.window used to hand back the log itself at this point, so the new sample
+            # was appended to the log twice and the frame kept the previous sample.
+            repeats = 2
+        else:
+            repeats = 1
+            slot = (self.tail - 1) % self.capacity
+            u = self.times[slot] - self.origin
+            v = self.values[slot]
+            n -= 1
+            w1 -= u
+            w2 -= u * u
+            v0 -= v
+            v1 -= v * u
+            v2 -= v * u * u
+
+        average = value
+        if n > 0:
+            u1 = self.times[self.head % self.capacity] - self.origin
+            dt = (t - self.origin) - u1
+            den = w2 - 2 * u1 * w1 + u1 * u1 * n + dt * dt
+            if den > 0:
+                num = v2 - 2 * u1 * v1 + u1 * u1 * v0 + value * dt * dt
+                average = num / den
+
+        self._append(t, value, repeats)
+        self.average = average
+        return average
+
+    def add(self, t, value):
+        """
+        Add a sample to the window without computing a rolling average for it.
+        """
+        self._append(t, value, 1)
+
+    def mean(self):
+        count = self.tail - self.start
+        if count <= 0:
+            return 0
+        total = self.total
+        for seq in range(self.head, self.start):
+            total -= self.values[seq % self.capacity]
+        return total / count
+
+    def minimum(self):
+        if not self.lows:
+            return 0
+        return self.values[self.lows[0] % self.capacity]
+
+    def maximum(self):
+        if not self.highs:
+            return 0
+        return self.values[self.highs[0] % self.capacity]
+
+    def _append(self, t, value, repeats):
+        if self.tail == self.head:
+            self.origin = t
+        elif self.tail - self.head == self.capacity:
+            self._grow()
+
+        seq = self.tail
+        slot = seq % self.capacity
+        self.times[slot] = t
+        self.values[slot] = value
+        self.repeats[slot] = repeats
+        self.tail += 1
+        self.pushed += repeats
+
+        u = t - self.origin
+        self.n += repeats
+        self.w1 += repeats * u
+        self.w2 += repeats * u * u
+        self.v0 += repeats * value
+        self.v1 += repeats * value * u
+        self.v2 += repeats * value * u * u
+        self.total += value
+
+        while self.lows and self.values[self.lows[-1] % self.capacity] >= value:
+            self.lows.pop()
+        self.lows.append(seq)
+        while self.highs and self.values[self.highs[-1] % self.capacity] <= value:
+            self.highs.pop()
+        self.highs.append(seq)
+
+        while t - self.times[self.start % self.capacity] > self.seconds:
+            self.start += 1
+
+        # Keep the two log entries before the window edge, where repeated samples count twice.
+        while self._outside() - self.repeats[self.head % self.capacity] >= 2:
+            self._drop_head()
+
+        while self.lows[0] < self.start:
+            self.lows.popleft()
+        while self.highs[0] < self.start:
+            self.highs.popleft()
+
+        if self.tail >= self.rebase_at:
+            self._rebase()
+
+    def _outside(self):
+        outside = 0
+        for seq in range(self.head, self.start):
+            outside += self.repeats[seq % self.capacity]
+        return outside
+
+    def _drop_head(self):
+        slot = self.head % self.capacity
+        repeats = self.repeats[slot]
+        u = self.times[slot] - self.origin
+        v = self.values[slot]
+        self.n -= repeats
+        self.w1 -= repeats * u
+        self.w2 -= repeats * u * u
+        self.v0 -= repeats * v
+        self.v1 -= repeats * v * u
+        self.v2 -= repeats * v * u * u
+        self.total -= v
+        self.head += 1
+
+    def _rebase(self):
+        """
+        Recompute the running sums from the retained samples.  This happens once per turn of the
+        ring buffer, so it stays constant time amortized, and it stops rounding error from piling
+        up over a long session.
+        """
+        self.origin = self.times[self.head % self.capacity]
+        self.n = 0
+        self.w1 = 0.0
+        self.w2 = 0.0
+        self.v0 = 0.0
+        self.v1 = 0.0
+        self.v2 = 0.0
+        self.total = 0.0
+        for seq in range(self.head, self.tail):
+            slot = seq % self.capacity
+            repeats = self.repeats[slot]
+            u = self.times[slot] - self.origin
+            v = self.values[slot]
+            self.n += repeats
+            self.w1 += repeats * u
+            self.w2 += repeats * u * u
+            self.v0 += repeats * v
+            self.v1 += repeats * v * u
+            self.v2 += repeats * v * u * u
+            self.total += v
+        self.rebase_at = self.tail + self.capacity
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        times = array("d", bytes(8 * capacity))
+        values = array("d", bytes(8 * capacity))
+        repeats = array("B", bytes(capacity))
+        for seq in range(self.head, self.tail):
+            old_slot = seq % self.capacity
+            new_slot = seq % capacity
+            times[new_slot] = self.times[old_slot]
+            values[new_slot] = self.values[old_slot]
+            repeats[new_slot] = self.repeats[old_slot]
+        self.capacity = capacity
+        self.times = times
+        self.values = values
+        self.repeats = repeats
+
+
+class RollingStats:
+    """
+    Several rolling windows of different lengths, all fed from the same stream.
+    """
+
+    def __init__(self, windows=(5, 30, 60)):
+        self.windows = {seconds: RollingWindow(seconds) for seconds in windows}
+
+    def __getitem__(self, seconds):
+        return self.windows[seconds]
+
+    def push(self, t, value):
+        for window in self.windows.values():
+            window.push(t, value)
+
+    def add(self, t, value):
+        for window in self.windows.values():
+            window.add(t, value)
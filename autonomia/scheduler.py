@@ -0,0 +1,90 @@
+import time
+
+
+class Scheduler:
+    """
+    Runs a phase of the workout as three jobs that each keep their own rate: sampling the session
+    for new data, handling input and drawing.  Between jobs it sleeps until the next one is due,
+    so how quickly keys are answered and how often the screen is drawn don't depend on how often
+    the sensors have something new.
+
+    Replays run on a clock of their own that only moves when the scheduler sleeps, so the jobs
+    keep the same proportions however fast the replay goes.
+    """
+
+    def __init__(self, session, gui):
+        self.session = session
+        self.gui = gui
+        config = session.config
+        self.sample_interval = 1 / config.sample_rate
+        self.input_interval = 1 / config.input_rate
+        self.render_interval = 1 / config.render_rate
+        self.replay_time = 0.0
+
+    def clock(self):
+        if self.session.live:
+            return time.monotonic()
+        return self.replay_time
+
+    def sleep_until(self, deadline):
+        delay = deadline - self.clock()
+        if delay > 0:
+            if not self.session.live:
+                self.replay_time += delay
+            self.session.sleep(delay)
+
+    def next_deadline(self, name, deadline, interval, now):
+        """
+        Returns when a job that was due at `deadline` is due again.  A job that has fallen behind
+        skips the runs it missed instead of running them back to back.
+        """
+        profiler = self.gui.profiler
+        if profiler.enabled:
+            profiler.record(f"{name} late", now - deadline)
+
+        deadline += interval
+        if deadline <= now:
+            deadline = now + interval
+        return deadline
+
+    def run(self, finished, sample, handle_keys, draw):
+        """
+        Until `finished()` is true, call `sample()` at the sample rate, `handle_keys(keys)` with
+        the keys pressed at the input rate, and `draw()` at the render rate.  `sample` returns
+        whether there was new data, which is used to time how long it takes to reach the screen.
+        """
+        profiler = self.gui.profiler
+        sampled_at = None
+
+        now = self.clock()
+        next_sample = now
+        next_input = now
+        next_render = now
+
+        while not finished():
+            now = self.clock()
+            if now >= next_sample:
+                next_sample = self.next_deadline("sample", next_sample, self.sample_interval, now)
+                if sample() and sampled_at is None:
+                    sampled_at = time.perf_counter()
+                if finished():
+                    break
+
+            if now >= next_input:
+                next_input = self.next_deadline("input", next_input, self.input_interval, now)
+                handle_keys(self.gui.pump_events())
+                if finished():
+                    break
+
+            if now >= next_render:
+                next_render = self.next_deadline("render", next_render, self.render_interval, now)
+                drawn = time.monotonic()
+                draw()
+                self.gui.present()
+                self.session.frame_presented(drawn, time.monotonic())
+                if sampled_at is not None:
+                    if profiler.enabled:
+                        profiler.record("sample to screen", time.perf_counter() - sampled_at)
+                    sampled_at = None
+
+            self.sleep_until(min(next_sample, next_input, next_render))
@@ -2,12 +2,20 @@
 
 import datetime
 import time
-import json
 import os
-from enum import IntEnum
+from array import array
+from bisect import bisect_left
+from itertools import compress, repeat
+from operator import ge
 import config
 import bluetooth
-from misc import zero_pad
+from pulse_ring import iter_records
+import binary_log
+import json_log
+from recorder import Recorder
+from misc import zero_pad, percentiles
+from rolling import RollingStats
+from event_log import Phase, Event, EventLog, COLUMN_NAMES
 
 # todo: install PyRow properly somewhere
 import os, sys
@@ -15,36 +23,31 @@ sys.path.append(os.path.join(os.getcwd(), "..", "PyRow"))
 import pyrow
 
 
-class Phase(IntEnum):
-    INVALID = -1
-    RESTING_BPM = 0
-    PENDING = 1
-    CALIBRATION = 2
-    STEADY = 3
-    COOLDOWN = 4
-    FULLSTOP = 5
-    RESULTS = 6
-    SHUTDOWN = 7
+# Lengths in seconds of the rolling windows tracked during a live session.  The first one
+# provides the logged `bpm_rolling_average`.
+ROLLING_WINDOWS = (5, 30, 60)
 
+# The event columns stored in each row of a JSON log, in order.
+LOG_FIELDS = (
+    "phase", "time", "bpm", "cadence", "watts", "distance",
+    "target_cadence", "target_watts", "bpm_rolling_average", "rr_interval")
 
-class Event:
-    def __init__(self):
-        self.phase = Phase.INVALID
-        self.time = 0
-
-        self.bpm = 0
-        self.bpm_rolling_average = 0
-        self.rr_interval = 0
 
-        self.cadence = 0
-        self.target_cadence = 0
-
-        self.watts = 0
-        self.target_watts = 0
-
-        self.distance = 0
+def log_from_rows(rows):
+    """
+    Build an `EventLog` out of rows from a JSON log.  Older logs only store a prefix of the
+    current row layout.
+    """
+    row_length = len(rows[0]) if rows else 0
+    if row_length == 10:
+        rows = [row for row in rows if row[2] >= 1]
+    elif row_length != 9 and row_length != 6:
+        rows = []
 
-        self.error = False
+    columns = dict(zip(LOG_FIELDS, zip(*rows)))
+    if row_length == 6:
+        columns["bpm_rolling_average"] = columns.get("bpm", ())
+    return EventLog(columns)
 
 
 class Session:
@@ -59,10 +62,13 @@ class Session:
         self.date = now.strftime("%Y_%m_%d")
         self.start_time = now.strftime("%I:%M %p")
         self.resting_bpm = 0
-        self.log = []
+        self.log = EventLog()
+        self.rolling = RollingStats(ROLLING_WINDOWS)
         self.phase = Phase.INVALID
         self.live = False
         self.manual_session = False
+        self.recorder = None
+        self.trimmed = 0 # rows dropped from the front of the log once they were on disk
 
         self.speed = 1
 
@@ -81,44 +87,37 @@ class Session:
     def set_phase(self, phase):
         assert(type(phase) == Phase)
         self.phase = phase
-
-    def window(self, samples, seconds):
-        if len(samples) <= 1:
-            return samples
-        last_t = samples[-1].time
-        seek = 1
-        for sample in samples[::-1]:
-            if last_t - sample.time <= seconds:
-                seek += 1
-            else:
-                break
-        start = (seek + 1) * -1
-        frame = samples[start:-1]
-        return frame
-
-    def weighted_average(self, rows, stat_name, exponent=0):
-        if len(rows) < 1:
-            return 0
-        elif len(rows) == 1:
-            return getattr(rows[0], stat_name)
-        elif exponent <= 0:
-            return sum([getattr(event, stat_name) for event in rows]) / len(rows)
+        if self.recorder:
+            self.flush_log()
+
+    def record(self, event):
+        """
+        Append an event to the log, filling in its rolling average unless it is an error.
+        """
+        if event.error:
+            self.rolling.add(event.time, event.bpm)
         else:
-            acc_v = 0
-            acc_w = 0
-            samples = [(event.time, getattr(event, stat_name)) for event in rows]
-            t1 = samples[0][0]
-            tN = samples[-1][0]
-            dt = tN - t1
-            for t, stat in samples:
-                a = (t - t1) / dt
-                a_exp = a ** exponent
-                acc_v += stat * a_exp
-                acc_w += a_exp
-            return acc_v / acc_w
-
-    def log_window(self, seconds):
-        return self.window(self.log, seconds)
+            self.rolling.push(event.time, event.bpm)
+            event.bpm_rolling_average = self.rolling[ROLLING_WINDOWS[0]].average
+
+        # Events can still be edited until the next one arrives, so only older ones get flushed.
+        if self.recorder and self.recorder.due():
+            self.flush_log()
+        self.log.append(event)
+
+    def flush_log(self):
+        """
+        Write the log out to disk, except for the events still waiting to be filled in.
+        """
+        length = len(self.log)
+        self.log = self.recorder.flush(self.log, length - self.unfinished_rows())
+        self.trimmed += length - len(self.log)
+
+    def unfinished_rows(self):
+        """
+        How many of the newest events will still be edited after the next one arrives.
+        """
+        return 0
 
     def connect_bluetooth(self, bluetooth_address):
         return True
@@ -129,60 +128,67 @@ class Session:
     def advance(self):
         return 0
 
+    def frame_presented(self, drawn, presented):
+        """
+        Called with the time.monotonic() a frame started being drawn at and when it was shown.
+        """
+        pass
+
     def shutdown(self):
         pass
 
+    def header(self):
+        """
+        Everything about the session that is stored alongside the event log.
+        """
+        return {
+            "date" : self.date,
+            "start_time" : self.start_time,
+            "manual_session" : self.manual_session,
+            "resting_bpm" : self.resting_bpm,
+            "intervals" : self.config.intervals,
+            "calibration_time" : self.config.calibration_time,
+            "steady_time" : self.config.steady_time,
+            "cooldown_time" : self.config.cooldown_time,
+            "target_low" : self.config.target_bpm_low,
+            "target_high" : self.config.target_bpm_high,
+            "target_bias" : self.config.target_bpm_bias,
+        }
+
+    def log_path(self, prefix=""):
+        out_path_template = f"{prefix}{self.date}_rowing_log{{}}"
+        out_path = out_path_template.format("")
+
+        counter = 0
+        while os.path.exists(out_path + ".json") or os.path.exists(out_path + binary_log.EXTENSION):
+            counter += 1
+            out_path = out_path_template.format(f"_{zero_pad(counter, 3)}")
+
+        return out_path + binary_log.EXTENSION
+
+    def start_recording(self):
+        """
+        Stream the log to disk as the session runs instead of writing it all out at the end.
+        """
+        assert(self.live)
+        self.recorder = Recorder(
+            self.log_path(), self.header(), self.config.flush_interval, self.config.log_tail_length)
+
     def save_to_disk(self, abort=False):
         prefix = ""
         if not self.live:
             prefix = "REPLAY_"
         if abort:
             prefix = "HALTED_"
-        out_path_template = f"{prefix}{self.date}_rowing_log{{}}.json"
-        out_path = out_path_template.format("")
 
-        counter = 0
-        while os.path.exists(out_path):
-            counter += 1
-            out_path = out_path_template.format(f"_{zero_pad(counter, 3)}")
-
-        log_headers = [
-            "phase", "elapsed_time", "bpm", "cadence", "watts", "distance",
-            "target cadence", "target watts", "bpm_rolling_average", "rr_interval"]
-
-        logged_stats = []
-        for e in self.log:
-            phase = int(e.phase)
-            t = e.time
-            bpm = e.bpm
-            cadence = e.cadence
-            watts = e.watts
-            distance = e.distance
-            target_cadence = e.target_cadence
-            target_watts = e.target_watts
-            weighted_bpm = e.bpm_rolling_average
-            rr_interval = e.rr_interval
-            row = (phase, t, bpm, cadence, watts, distance, target_cadence, target_watts, weighted_bpm, rr_interval)
-            logged_stats.append(row)
-
-        # should probably just dump all of this into a sqlite database
-        with open(out_path, "w") as out_file:
-            log_blob = {
-                "date" : self.date,
-                "start_time" : self.start_time,
-                "manual_session" : self.manual_session,
-                "resting_bpm" : self.resting_bpm,
-                "intervals" : self.config.intervals,
-                "calibration_time" : self.config.calibration_time,
-                "steady_time" : self.config.steady_time,
-                "cooldown_time" : self.config.cooldown_time,
-                "target_low" : self.config.target_bpm_low,
-                "target_high" : self.config.target_bpm_high,
-                "target_bias" : self.config.target_bpm_bias,
-                "log_headers" : log_headers,
-                "log" : logged_stats,
-            }
-            out_file.write(json.dumps(log_blob))
+        if self.recorder:
+            out_path = self.log_path(prefix) if prefix else None
+            length = len(self.log)
+            self.log = self.recorder.finish(self.log, self.header(), out_path)
+            self.trimmed += length - len(self.log)
+            self.recorder = None
+        else:
+            binary_log.write(self.log_path(prefix), self.header(), self.log)
 
         print("Workout complete!")
         self.shutdown()
@@ -236,15 +242,7 @@ class RowingSession(Session):
 
         event.distance = sum(reply["CSAFE_PM_GET_WORKDISTANCE"][0:2]) / 10.0
 
-        window_seq = self.log_window(5)
-        window_seq.append(event)
-
-        if len(window_seq) > 1:
-            event.bpm_rolling_average = self.weighted_average(window_seq, "bpm", 2)
-        else:
-            event.bpm_rolling_average = event.bpm
-
-        self.log.append(event)
+        self.record(event)
         return event
 
 
@@ -262,6 +260,24 @@ class ManualSession(Session):
 
         self.stream_time = 0
 
+        # The stream clock is the sum of the rr intervals, and is compared against when the
+        # notifications arrived, starting from the first one.
+        self.first_received = None
+        self.stream_origin = 0
+        self.drift = array("d")
+
+        # The events that haven't been on screen yet, as (row, received, read) times.  Rows count
+        # from the start of the session, since the log may be trimmed before they are shown.
+        self.unshown = []
+
+        # Seconds spent in each stage between a notification arriving and it being on screen.
+        self.latencies = {
+            "arrival to read" : array("d"),
+            "read to draw" : array("d"),
+            "draw to present" : array("d"),
+            "pulse to pixel" : array("d"),
+        }
+
     def connect_bluetooth(self, bluetooth_address):
         bluetooth.start(bluetooth_address)
         while True:
@@ -283,14 +299,73 @@ class ManualSession(Session):
         return True
 
     def shutdown(self):
+        self.latency_report()
         bluetooth.stop()
 
+    def latency_report(self):
+        for stage, samples in self.latencies.items():
+            if len(samples) > 0:
+                p50, p95, p99 = percentiles(samples, (.5, .95, .99))
+                print(
+                    f"{stage:16} p50 {p50 * 1000:7.1f} ms, p95 {p95 * 1000:7.1f} ms, "
+                    f"p99 {p99 * 1000:7.1f} ms, max {max(samples) * 1000:7.1f} ms")
+        if len(self.drift) > 0:
+            print(
+                f"stream clock drift {self.drift[-1]:+.3f} s "
+                f"(between {min(self.drift):+.3f} s and {max(self.drift):+.3f} s)")
+
+    def unfinished_rows(self):
+        if self.unshown:
+            return self.trimmed + len(self.log) - self.unshown[0][0]
+        return 0
+
+    def frame_presented(self, drawn, presented):
+        if self.unshown:
+            display_latency = self.log.display_latency
+            for row, received, read_at in self.unshown:
+                if row >= self.trimmed:
+                    display_latency[row - self.trimmed] = presented - received
+                self.latencies["read to draw"].append(drawn - read_at)
+                self.latencies["draw to present"].append(presented - drawn)
+                self.latencies["pulse to pixel"].append(presented - received)
+            self.unshown = []
+
+    def record_message(self, message_type, data):
+        if message_type == "status" or message_type == "fatal":
+            self.connected = False
+
+            print(message_type, data)
+            err = Event()
+            err.phase = self.phase
+            err.time = self.stream_time / 1000
+            err.error = f"{message_type}: {str(data)}"
+            self.record(err)
+
     def advance(self):
         event = None
-        for message_type, data in bluetooth.read():
-            if message_type == "pulse":
+        messages = bluetooth.read_messages()
+        pending = 0
+
+        # Everything the heart rate monitor sent since the last call arrives in one read.  The
+        # messages come separately, and are put back in between the pulses by when they arrived.
+        read_at = time.monotonic()
+        for received, bpm, flags, rr_intervals in iter_records(bluetooth.read_pulses()):
+            while pending < len(messages) and messages[pending][2] <= received:
+                self.record_message(*messages[pending][:2])
+                pending += 1
+
+            # The last interval in a notification ends about when it arrives, so that is where
+            # the stream clock is compared with the monotonic one.
+            packet_end = self.stream_time + sum(rr_intervals)
+            if self.first_received is None:
+                self.first_received = received
+                self.stream_origin = packet_end
+            drift = (packet_end - self.stream_origin) / 1000 - (received - self.first_received)
+            self.drift.append(drift)
+            self.latencies["arrival to read"].append(read_at - received)
+
+            for rr_interval in rr_intervals:
                 self.connected = True
-                rr_interval = data
                 self.stream_time += rr_interval
                 event = Event()
                 event.phase = self.phase
@@ -298,26 +373,13 @@ class ManualSession(Session):
                 event.rr_interval = rr_interval
                 event.bpm = 60_000 / rr_interval
                 event.bpm_rolling_average = 0
+                event.receive_latency = read_at - received
+                event.stream_drift = drift
+                self.record(event)
+                self.unshown.append((self.trimmed + len(self.log) - 1, received, read_at))
 
-                window_seq = self.log_window(5)
-                window_seq.append(event)
-
-                if len(window_seq) > 1:
-                    event.bpm_rolling_average = self.weighted_average(window_seq, "bpm", 2)
-                else:
-                    event.bpm_rolling_average = event.bpm
-
-                self.log.append(event)
-
-            elif message_type == "status" or message_type == "fatal":
-                self.connected = False
-
-                print(message_type, data)
-                err = Event()
-                err.phase = self.phase
-                err.time = self.stream_time / 1000
-                err.error = f"{message_type}: {str(data)}"
-                self.log.append(err)
+        for message in messages[pending:]:
+            self.record_message(*message[:2])
 
         if event and event.bpm > 1 and not event.error:
             return event
@@ -326,11 +388,22 @@ class ManualSession(Session):
 
 
 class ReplaySession(Session):
-    def __init__(self, replay_path, replay_speed = None):
+    def __init__(self, replay_path, replay_speed = None, store = None, columns = COLUMN_NAMES):
         Session.__init__(self)
 
-        with open(replay_path, "r") as infile:
-            self.replay = json.loads(infile.read())
+        self.session_id = None
+        self.binary = None # the binary log the replay's columns are mapped from
+        self.pending_rows = None # rows of a JSON log that haven't been parsed yet
+        if store is not None:
+            # `columns` limits what is read back out of the database.
+            self.session_id = store.session_id(replay_path)
+            self.replay = store.header(self.session_id)
+            self.replay_log = store.load_log(self.session_id, columns)
+        elif binary_log.is_binary_log(replay_path):
+            self.replay, self.replay_log = self.load_binary(replay_path)
+        else:
+            self.replay, self.pending_rows = json_log.read(replay_path)
+            self.replay_log = EventLog()
 
         self.speed_override = replay_speed
         if self.speed_override is not None:
@@ -341,6 +414,7 @@ class ReplaySession(Session):
 
         self.date = self.replay["date"]
         self.start_time = self.replay.get("start_time", "")
+        self.manual_session = self.replay.get("manual_session", False)
         self.resting_bpm = self.replay["resting_bpm"]
 
         self.config.intervals = self.replay["intervals"]
@@ -351,55 +425,57 @@ class ReplaySession(Session):
         self.config.target_bpm_high = self.replay["target_high"]
         self.config.target_bpm_bias = self.replay.get("target_bias", .5)
 
-        self.replay_log = []
-
-        if len(self.replay["log"][0]) == 10:
-            for row in self.replay["log"]:
-                phase, t, bpm, cadence, watts, distance, target_cadence, target_watts, weighted_bpm, rr_interval = row
-                if bpm < 1:
-                    continue
-                e = Event()
-                e.phase = Phase(phase)
-                e.time = t
-                e.bpm = bpm
-                e.cadence = cadence
-                e.watts = watts
-                e.distance = distance
-                e.target_cadence = target_cadence
-                e.target_watts = target_watts
-                e.bpm_rolling_average = weighted_bpm
-                e.rr_interval = rr_interval
-                self.replay_log.append(e)
-
-        elif len(self.replay["log"][0]) == 9:
-            for row in self.replay["log"]:
-                phase, t, bpm, cadence, watts, distance, target_cadence, target_watts, weighted_bpm = row
-                e = Event()
-                e.phase = Phase(phase)
-                e.time = t
-                e.bpm = bpm
-                e.cadence = cadence
-                e.watts = watts
-                e.distance = distance
-                e.target_cadence = target_cadence
-                e.target_watts = target_watts
-                e.bpm_rolling_average = weighted_bpm
-                self.replay_log.append(e)
-
-        elif len(self.replay["log"][0]) == 6:
-            for row in self.replay["log"]:
-                phase, t, bpm, cadence, watts, distance = row
-                e = Event()
-                e.phase = Phase(phase)
-                e.time = t
-                e.bpm = bpm
-                e.cadence = cadence
-                e.watts = watts
-                e.distance = distance
-                e.target_cadence = 0
-                e.target_watts = 0
-                e.bpm_rolling_average = bpm
-                self.replay_log.append(e)
+    def load_rows(self, count=None):
+        """
+        Parse rows of a JSON log until at least `count` events are available, or until the whole
+        log is loaded if `count` is None.
+        """
+        while self.pending_rows is not None and (count is None or len(self.replay_log) < count):
+            rows = next(self.pending_rows, None)
+            if rows is None:
+                self.pending_rows = None
+            else:
+                self.replay_log.extend(log_from_rows(rows))
+        return len(self.replay_log)
+
+    def load_binary(self, replay_path):
+        binary = binary_log.BinaryLog(replay_path)
+        columns = binary.columns
+        bpms = columns["bpm"]
+
+        # Rows without a heart rate are skipped, same as for JSON logs.  This is the only case
+        # where the columns get copied instead of being used straight from the file.
+        if len(bpms) == 0 or min(bpms) >= 1:
+            self.binary = binary
+            return binary.header, EventLog(columns, binary.errors)
+
+        with binary:
+            keep = list(map(ge, bpms, repeat(1)))
+            kept = list(compress(range(len(keep)), keep))
+            columns = {
+                name : array(typecode, compress(columns[name], keep))
+                for name, typecode in binary.stored_columns}
+
+            # Errors on the rows that were skipped go with them, same as for JSON logs, and the
+            # rest follow their rows to where they ended up.
+            errors = {}
+            for index, error in binary.errors.items():
+                kept_index = bisect_left(kept, index)
+                if kept_index < len(kept) and kept[kept_index] == index:
+                    errors[kept_index] = error
+
+            return binary.header, EventLog(columns, errors)
+
+    def close(self):
+        """
+        Unmap the binary log the replay was read from, if any.  The replayed events can't be
+        used afterwards.
+        """
+        if self.binary is not None:
+            self.replay_log = EventLog()
+            self.log = EventLog()
+            self.binary.close()
+            self.binary = None
 
     def now(self):
         return time.time()
@@ -424,26 +500,31 @@ class ReplaySession(Session):
         assert(type(phase) == Phase)
 
         if phase == Phase.RESULTS:
-            while self.advance(drain=True) is not None:
-                pass
+            # Everything left goes into the log in one step.
+            self.load_rows()
+            if len(self.log) == 0 and self.seek == 0:
+                self.log = self.replay_log
+            else:
+                self.log.extend(self.replay_log, self.seek)
+            self.seek = len(self.replay_log)
             self.phase = Phase.RESULTS
             self.update_speed()
 
         elif phase != self.phase:
-            cursor = self.seek
-            for event in self.replay_log[cursor:]:
-                if event.phase == phase:
+            phases = self.replay_log.phase
+            while self.load_rows(self.seek + 1) > self.seek:
+                if phases[self.seek] == phase:
                     self.phase = phase
                     self.update_speed()
                     return
                 else:
-                    self.log.append(event)
+                    self.log.append(self.replay_log[self.seek])
                     self.seek += 1
             self.phase = Phase.RESULTS
             self.update_speed()
 
     def advance(self, drain=False):
-        if self.seek < len(self.replay_log):
+        if self.seek < self.load_rows(self.seek + 1):
             event = self.replay_log[self.seek]
             self.log.append(event)
             self.seek += 1
@@ -0,0 +1,215 @@
+import os
+import glob
+import sqlite3
+from event_log import COLUMNS, COLUMN_NAMES, EventLog
+from session import ReplaySession
+
+
+HEADER_FIELDS = (
+    "date", "start_time", "manual_session", "resting_bpm", "intervals", "calibration_time",
+    "steady_time", "cooldown_time", "target_low", "target_high", "target_bias")
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    manual_session INTEGER NOT NULL,
+    resting_bpm REAL NOT NULL,
+    intervals INTEGER NOT NULL,
+    calibration_time REAL NOT NULL,
+    steady_time REAL NOT NULL,
+    cooldown_time REAL NOT NULL,
+    target_low REAL NOT NULL,
+    target_high REAL NOT NULL,
+    target_bias REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    phase INTEGER NOT NULL,
+    time REAL NOT NULL,
+    bpm REAL NOT NULL,
+    bpm_rolling_average REAL NOT NULL,
+    rr_interval REAL NOT NULL,
+    cadence INTEGER NOT NULL,
+    target_cadence INTEGER NOT NULL,
+    watts INTEGER NOT NULL,
+    target_watts INTEGER NOT NULL,
+    distance REAL NOT NULL,
+    receive_latency REAL NOT NULL DEFAULT 0,
+    display_latency REAL NOT NULL DEFAULT 0,
+    stream_drift REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS phases (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    phase INTEGER NOT NULL,
+    first_seq INTEGER NOT NULL,
+    last_seq INTEGER NOT NULL,
+    start_time REAL NOT NULL,
+    stop_time REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS sessions_by_date ON sessions (date);
+CREATE INDEX IF NOT EXISTS events_by_phase ON events (session_id, phase, seq);
+CREATE INDEX IF NOT EXISTS events_by_time ON events (session_id, time);
+CREATE INDEX IF NOT EXISTS phases_by_session ON phases (session_id, phase);
+"""
+
+
+class SessionStore:
+    """
+    An SQLite database of workout sessions, as an alternative to globbing and parsing every log
+    file.  Logs are imported once, and after that callers can ask for just the sessions, phases,
+    rows and columns they need.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+        # Databases made before a column was added to the log get it added, zeroed.
+        existing = set(row[1] for row in self.db.execute("PRAGMA table_info(events)"))
+        for name, typecode in COLUMNS:
+            if name not in existing:
+                kind = "INTEGER" if typecode in "bq" else "REAL"
+                self.db.execute(f"ALTER TABLE events ADD COLUMN {name} {kind} NOT NULL DEFAULT 0")
+
+    def close(self):
+        self.db.close()
+
+    def import_log(self, path):
+        """
+        Import a single log file, replacing any earlier import of the same path.  Returns False if
+        the file hasn't changed since it was last imported.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.db.execute(
+            "SELECT mtime, size FROM sessions WHERE path = ?", (path,)).fetchone()
+        if known == (stat.st_mtime, stat.st_size):
+            return False
+
+        session = ReplaySession(path)
+        session.load_rows()
+        header = session.header()
+        log = session.replay_log
+
+        with self.db:
+            self.db.execute("DELETE FROM sessions WHERE path = ?", (path,))
+            cursor = self.db.execute(
+                f"INSERT INTO sessions (path, mtime, size, {', '.join(HEADER_FIELDS)}) "
+                f"VALUES (?, ?, ?, {', '.join('?' * len(HEADER_FIELDS))})",
+                (path, stat.st_mtime, stat.st_size,
+                 *[header[field] for field in HEADER_FIELDS]))
+            session_id = cursor.lastrowid
+
+            errors = log.errors
+            self.db.executemany(
+                f"INSERT INTO events (session_id, seq, {', '.join(COLUMN_NAMES)}, error) "
+                f"VALUES (?, ?, {', '.join('?' * len(COLUMN_NAMES))}, ?)",
+                ((session_id, seq, *row, errors.get(seq))
+                 for seq, row in enumerate(zip(*log.columns))))
+
+            phases = []
+            for seq, (phase, t) in enumerate(zip(log.phase, log.time)):
+                if phases and phases[-1][1] == phase:
+                    phases[-1][3] = seq
+                    phases[-1][5] = t
+                else:
+                    phases.append([session_id, phase, seq, seq, t, t])
+            self.db.executemany("INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?)", phases)
+
+        session.close()
+        return True
+
+    def import_logs(self, paths):
+        """
+        Import every log in `paths` that is new or has changed.  Returns the number imported.
+        """
+        return sum(1 for path in paths if self.import_log(path))
+
+    def sessions(self, first_date=None, last_date=None):
+        """
+        Returns (session id, path, header) for every session, optionally restricted to a range of
+        dates in the "YYYY_MM_DD" form logs use.
+        """
+        query = f"SELECT id, path, {', '.join(HEADER_FIELDS)} FROM sessions"
+        clauses = []
+        params = []
+        if first_date is not None:
+            clauses.append("date >= ?")
+            params.append(first_date)
+        if last_date is not None:
+            clauses.append("date <= ?")
+            params.append(last_date)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY date, path"
+
+        found = []
+        for row in self.db.execute(query, params):
+            header = dict(zip(HEADER_FIELDS, row[2:]))
+            header["manual_session"] = bool(header["manual_session"])
+            found.append((row[0], row[1], header))
+        return found
+
+    def session_id(self, path):
+        row = self.db.execute(
+            "SELECT id FROM sessions WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    def header(self, session_id):
+        row = self.db.execute(
+            f"SELECT {', '.join(HEADER_FIELDS)} FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        header = dict(zip(HEADER_FIELDS, row))
+        header["manual_session"] = bool(header["manual_session"])
+        return header
+
+    def load_log(self, session_id, columns=COLUMN_NAMES, phase=None):
+        """
+        Build an `EventLog` for a session out of only the requested columns, and optionally only
+        the rows of one phase.  Columns that weren't asked for are left zeroed.
+        """
+        query = f"SELECT {', '.join(columns)} FROM events WHERE session_id = ?"
+        params = [session_id]
+        if phase is not None:
+            query += " AND phase = ?"
+            params.append(int(phase))
+        query += " ORDER BY seq"
+
+        rows = self.db.execute(query, params).fetchall()
+        log = EventLog(dict(zip(columns, zip(*rows))))
+
+        if len(rows) > 0 and phase is None:
+            for seq, error in self.db.execute(
+                    "SELECT seq, error FROM events WHERE session_id = ? AND error IS NOT NULL",
+                    (session_id,)):
+                log.errors[seq] = error
+        return log
+
+    def phases(self, session_id):
+        """
+        Returns (phase, first row, last row, start time, stop time) for each run of a phase.
+        """
+        return self.db.execute(
+            "SELECT phase, first_seq, last_seq, start_time, stop_time FROM phases "
+            "WHERE session_id = ? ORDER BY first_seq", (session_id,)).fetchall()
+
+
+def import_main(store_path):
+    store = SessionStore(store_path)
+    paths = glob.glob("????_??_??_rowing_log*")
+    imported = store.import_logs(paths)
+    print(f"Imported {imported} of {len(paths)} logs into {store_path}")
+    store.close()
@@ -4,15 +4,18 @@ import os
 import sys
 import math
 import glob
-import datetime
 import pygame
-from gui import Display
+from gui import Display, FrameStats
 from session import ManualSession, RowingSession, ReplaySession, Phase, Event
-from log_viewer import ResultsGraph
+from log_viewer import ResultsGraph, OverlayGraph, ViewCache
+from log_index import LogIndex
 from resting_bpm import RestingBPM
 from quiesce import FullStop
 from misc import zero_pad, lerp, pretty_time
 import metronome
+import binary_log
+from store import SessionStore
+from scheduler import Scheduler
 
 
 class ErgSearch:
@@ -264,7 +267,11 @@ def workout_main(gui, volume, bluetooth_address, no_erg = False,
         else:
             session = RowingSession()
 
+        if not no_save:
+            session.start_recording()
+
     keys = []
+    gui.profiler.session = session
 
     session.set_phase(Phase.RESTING_BPM)
 
@@ -284,89 +291,125 @@ def workout_main(gui, volume, bluetooth_address, no_erg = False,
     if not no_erg:
         lobby = ErgSearch()
         while not session.connect_erg():
-            lobby(gui)
+            with gui.profiler.section("draw erg search"):
+                lobby(gui)
             if present(None):
                 sys.exit(0)
 
+    # Sampling, input and drawing each run at their own rate from here on.
+    scheduler = Scheduler(session, gui)
+    latest = None
+    skip_requested = False
+
+    def sample():
+        """
+        Ask the session for new data, returning the new event if there is one.
+        """
+        nonlocal latest
+        with gui.profiler.section("advance"):
+            event = session.advance()
+        if event:
+            latest = event
+        return event
+
+    def skip_on(skip_key):
+        def handle_keys(keys):
+            nonlocal skip_requested
+            if keys.count(skip_key) > 0:
+                skip_requested = True
+        return handle_keys
+
     resting_phase = RestingBPM(session)
 
-    while session.phase == Phase.RESTING_BPM:
-        event = session.advance()
-        if not event:
-            continue
-        resting_phase(gui, session, event)
-        if present(pygame.K_SPACE):
-            session.set_phase(Phase.PENDING)
-            break
+    def resting_sample():
+        event = sample()
+        if event:
+            resting_phase.update(session, event)
+        return event
+
+    def resting_draw():
+        with gui.profiler.section("draw resting"):
+            resting_phase.draw(gui, session, latest)
+
+    scheduler.run(
+        lambda: session.phase != Phase.RESTING_BPM or skip_requested,
+        resting_sample, skip_on(pygame.K_SPACE), resting_draw)
+    if skip_requested:
+        session.set_phase(Phase.PENDING)
 
     if manual_cadence:
         print("?", manual_cadence, volume)
         metronome.reset(manual_cadence, volume)
 
     begin_phase = PleaseBegin()
+    skip_requested = False
 
-    while session.phase == Phase.PENDING:
-        event = session.advance()
-        if not event:
-            continue
-        for i in range(60):
-            begin_phase(gui, session, event)
-            gui.present()
-            if gui.pump_events().count(pygame.K_SPACE) > 0 or (session.workout_started() and not no_erg):
-                session.set_phase(Phase.CALIBRATION)
-                break
-            session.sleep(1/60)
+    def pending_sample():
+        nonlocal skip_requested
+        event = sample()
+        if session.workout_started() and not no_erg:
+            skip_requested = True
+        return event
+
+    def pending_draw():
+        with gui.profiler.section("draw begin"):
+            begin_phase(gui, session, latest)
+
+    scheduler.run(
+        lambda: session.phase != Phase.PENDING or skip_requested,
+        pending_sample, skip_on(pygame.K_SPACE), pending_draw)
+    if skip_requested:
+        session.set_phase(Phase.CALIBRATION)
 
     def remaining_time_str(stop_time):
         return pretty_time(max(int(stop_time - session.now()), 0))
 
     intervals = IntervalRunner(session, bpm_debug)
+    current_bpm = 0
+    stop_time = 0
 
-    def interval_present(skip_key):
-        gui.present()
-        for i in range(4):
-            keys = gui.pump_events()
-            if keys.count(skip_key) > 0:
-                return True
-            session.sleep(.25)
-        return False
+    def interval_sample():
+        nonlocal current_bpm, skip_requested
+        event = sample()
+        if event:
+            if session.live or session.phase == event.phase:
+                intervals.update(session, event)
+                current_bpm = event.bpm_rolling_average
+            else:
+                skip_requested = True
+        return event
+
+    def interval_keys(keys):
+        nonlocal manual_cadence, skip_requested
+        if keys.count(pygame.K_BACKSPACE) > 0:
+            skip_requested = True
+        elif manual_cadence and keys.count(pygame.K_UP) > 0:
+            manual_cadence += 1
+            metronome.tweak(manual_cadence, volume)
+        elif manual_cadence and keys.count(pygame.K_DOWN) > 0:
+            manual_cadence -= 1
+            metronome.tweak(manual_cadence, volume)
+
+    def interval_draw():
+        with gui.profiler.section("draw intervals"):
+            intervals.draw(gui, session, current_bpm, remaining_time_str(stop_time))
+
+    def interval_finished(phase):
+        return lambda: (
+            session.phase != phase or skip_requested or (session.live and session.now() > stop_time))
 
-    current_bpm = 0
     for interval in range(session.config.intervals):
         if not manual_cadence:
             metronome.tweak(15, 0)
 
-        calibration_stop_time = session.now() + session.config.calibration_time * 60
+        stop_time = session.now() + session.config.calibration_time * 60
         if session.phase == Phase.COOLDOWN:
             session.set_phase(Phase.CALIBRATION)
 
-        while session.phase == Phase.CALIBRATION:
-            event = session.advance()
-            if not event:
-                continue
-            skip_requested = False
-            if session.live or session.phase == event.phase:
-                intervals.update(session, event)
-                current_bpm = event.bpm_rolling_average
-                for i in range(15):
-                    intervals.draw(gui, session, current_bpm, remaining_time_str(calibration_stop_time))
-                    gui.present()
-                    keys = gui.pump_events()
-                    if keys.count(pygame.K_BACKSPACE) > 0:
-                        skip_requested = True
-                        break
-                    elif manual_cadence and keys.count(pygame.K_UP) > 0:
-                        manual_cadence += 1
-                        metronome.tweak(manual_cadence, volume)
-                    elif manual_cadence and keys.count(pygame.K_DOWN) > 0:
-                        manual_cadence -= 1
-                        metronome.tweak(manual_cadence, volume)
-                    session.sleep(1/15)
-            else:
-                skip_requested = True
-
-            if skip_requested or (session.live and session.now() > calibration_stop_time):
-                session.set_phase(Phase.STEADY)
+        skip_requested = False
+        scheduler.run(interval_finished(Phase.CALIBRATION), interval_sample, interval_keys, interval_draw)
+        if session.phase == Phase.CALIBRATION:
+            session.set_phase(Phase.STEADY)
 
         cadence = intervals.target_cadence
         if intervals.samples > 0:
@@ -375,92 +418,68 @@ def workout_main(gui, volume, bluetooth_address, no_erg = False,
         if not manual_cadence:
             metronome.reset(cadence, 1 * volume)
 
-        steady_stop_time = session.now() + session.config.steady_time * 60
+        stop_time = session.now() + session.config.steady_time * 60
 
-        while session.phase == Phase.STEADY:
-            event = session.advance()
-            if not event:
-                continue
-            skip_requested = False
-            if session.live or session.phase == event.phase:
-                intervals.update(session, event)
-                current_bpm = event.bpm_rolling_average
-                for i in range(60):
-                    intervals.draw(gui, session, current_bpm, remaining_time_str(steady_stop_time))
-                    gui.present()
-                    keys = gui.pump_events()
-                    if keys.count(pygame.K_BACKSPACE) > 0:
-                        skip_requested = True
-                        break
-                    elif manual_cadence and keys.count(pygame.K_UP) > 0:
-                        manual_cadence += 1
-                        metronome.tweak(manual_cadence, volume)
-                    elif manual_cadence and keys.count(pygame.K_DOWN) > 0:
-                        manual_cadence -= 1
-                        metronome.tweak(manual_cadence, volume)
-                    session.sleep(1/60)
-            else:
-                skip_requested = True
-
-            if skip_requested or (session.live and session.now() > steady_stop_time):
-                session.set_phase(Phase.COOLDOWN)
+        skip_requested = False
+        scheduler.run(interval_finished(Phase.STEADY), interval_sample, interval_keys, interval_draw)
+        if session.phase == Phase.STEADY:
+            session.set_phase(Phase.COOLDOWN)
 
         metronome.tweak(10, 0)
-        cooldown_stop_time = session.now() + session.config.cooldown_time * 60
+        stop_time = session.now() + session.config.cooldown_time * 60
 
-        while session.phase == Phase.COOLDOWN:
-            event = session.advance()
-            if not event:
-                continue
-            skip_requested = True
-            if session.live or session.phase == event.phase:
-                intervals.update(session, event)
-                current_bpm = event.bpm_rolling_average
-                intervals.draw(gui, session, current_bpm, remaining_time_str(cooldown_stop_time))
-                skip_requested = present(pygame.K_BACKSPACE)
-            if skip_requested or (session.live and session.now() > cooldown_stop_time):
-                # the beginning of the interval loop will seek, as will the code following
-                # said loop.
-                break
+        # the beginning of the interval loop will seek, as will the code following said loop.
+        skip_requested = False
+        scheduler.run(
+            interval_finished(Phase.COOLDOWN), interval_sample, skip_on(pygame.K_BACKSPACE), interval_draw)
 
     metronome.tweak(15, 0)
 
     session.set_phase(Phase.FULLSTOP)
     stop_phase = FullStop()
 
-    pulse = None
-    while session.phase == Phase.FULLSTOP:
-        event = session.advance()
-        if event:
-            pulse = event
-        stop_phase(gui, session, pulse)
+    def fullstop_keys(keys):
+        if keys.count(pygame.K_SPACE) > 0:
+            session.set_phase(Phase.CALIBRATION)
 
-        gui.present()
-        for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
-                session.set_phase(Phase.CALIBRATION)
-                break
+    def fullstop_draw():
+        with gui.profiler.section("draw full stop"):
+            stop_phase(gui, session, latest)
+
+    latest = None
+    scheduler.run(lambda: session.phase != Phase.FULLSTOP, sample, fullstop_keys, fullstop_draw)
 
     session.set_phase(Phase.RESULTS)
     if not no_save:
         session.save_to_disk()
 
     metronome.stop()
+    gui.profiler.save()
 
     # automatically open up the workout viewer
     viewer_main(gui)
 
 
-def find_bpm_min_max(sessions, margin=5):
+# How long the viewer sleeps waiting for input before waking up anyway, in seconds.
+VIEWER_IDLE_TIMEOUT = 1
+
+# How many sessions the viewer overlays at first, and at most.
+OVERLAY_SESSIONS = 10
+MAX_OVERLAY_SESSIONS = 20
+
+
+def find_bpm_min_max(summaries, margin=5):
     bpm_min = math.inf
     bpm_max = 0
 
-    for session in sessions:
-        for event in session.log:
-            if event.bpm_rolling_average > event.bpm * .5:
-                bpm_min = min(bpm_min, min(event.bpm, event.bpm_rolling_average))
-            bpm_max = max(bpm_max, max(event.bpm, event.bpm_rolling_average))
+    for summary in summaries:
+        bpm_min = min(bpm_min, summary.bpm_low)
+        bpm_max = max(bpm_max, summary.bpm_high)
+
+    return pad_bpm_range(bpm_min, bpm_max, margin)
 
+
+def pad_bpm_range(bpm_min, bpm_max, margin=5):
     bpm_min -= margin
     bpm_max += margin
     bpm_range = abs(bpm_max - bpm_min)
@@ -468,55 +487,147 @@ def find_bpm_min_max(sessions, margin=5):
     return bpm_min, bpm_max, bpm_range
 
 
-def viewer_main(gui, normalized_bpm_range = False):
-    log_paths = sorted(glob.glob("????_??_??_rowing_log*.json"))
+def log_sort_key(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
 
-    sessions = []
+def find_logs(store=None):
+    """
+    Returns the paths of the workout logs in the working directory, oldest first.  If there is a
+    session store, new logs are imported into it and the store's list of logs is used instead.
+    """
+    log_paths = sorted(
+        glob.glob("????_??_??_rowing_log*.json") + glob.glob(f"????_??_??_rowing_log*{binary_log.EXTENSION}"),
+        key=log_sort_key)
+
+    if store:
+        store.import_logs(log_paths)
+        log_paths = sorted((path for session_id, path, header in store.sessions()), key=log_sort_key)
+    return log_paths
+
+
+def load_summaries(log_paths, store=None):
+    """
+    Returns the summaries of every log that has anything in it.
+    """
+    # Only logs that are new or have changed since the last run get read here, spread over every
+    # core.  Everything after this just maps the summaries onto the screen.
+    log_index = LogIndex()
+    log_index.update(log_paths, store)
+    summaries = []
     for path in log_paths:
-        session = ReplaySession(path)
-        session.set_phase(Phase.RESULTS)
-        sessions.append(session)
+        summary = log_index.lookup(path, store)
+        if summary.rows == 0:
+            # a log that was cut short before anything was written out
+            continue
+        summaries.append(summary)
+    log_index.save(log_paths)
+    return summaries
 
-    views = []
-    if normalized_bpm_range:
-        bpm_stats = find_bpm_min_max(sessions)
-        views = [ResultsGraph(session, gui, bpm_stats, True) for session in sessions]
 
-    else:
-        for session in sessions:
-            bpm_stats = find_bpm_min_max([session])
-            views.append(ResultsGraph(session, gui, bpm_stats, False))
+def viewer_main(gui, normalized_bpm_range = False, store_path = None, frame_stats = False):
+    store = None
+    if store_path:
+        store = SessionStore(store_path)
+    summaries = load_summaries(find_logs(store), store)
 
+    global_stats = None
+    if normalized_bpm_range:
+        global_stats = find_bpm_min_max(summaries)
+
+    def build_view(index):
+        summary = summaries[index]
+        if normalized_bpm_range:
+            return ResultsGraph(summary, gui, global_stats, True)
+        return ResultsGraph(summary, gui, find_bpm_min_max([summary]), False)
 
     pygame.mouse.set_visible(True)
 
-    if len(views) == 0:
+    if len(summaries) == 0:
         print("No logs available.")
         return
 
-    current_view = len(views) - 1
-    current_mode = 4 # envelope mode
-    mode_count = 5 # actually 6, but I don't like the bezier mode
-    while True:
-        view = views[current_view]
-        view(gui, current_mode)
+    # Views are built as they are needed, and the ones nearby in the direction the user is moving
+    # are built ahead of time in the background.
+    views = ViewCache(build_view)
 
-        date_label = view.session.date.replace("_", ".")
-        weekday = datetime.datetime.strptime(view.session.date, "%Y_%m_%d").strftime("%A")
-        parts = [date_label, weekday]
-        if view.session.start_time:
-            parts.append(view.session.start_time)
-        date_label = "    ".join(parts)
-        gui.draw_text(date_label, view.margin_x1, view.margin_y1, font="smol", y_align=1)
+    def build_overlay(index, count, align_phase):
+        """
+        Overlay the `count` sessions up to and including the one at `index`.
+        """
+        overlaid = summaries[max(index - count + 1, 0):index + 1]
+        return OverlayGraph(overlaid, gui, find_bpm_min_max(overlaid), align_phase)
 
-        gui.present()
+    current_view = len(summaries) - 1
+    current_mode = 4 # envelope mode
+    mode_count = 5 # actually 6, but I don't like the bezier mode
+    direction = -1 # the newest session is shown first, so the rest are to the left
+    prefetched = None
+    shown = None
+    redraw = True
+    stats = FrameStats("viewer") if frame_stats else None
+
+    overlay = False
+    overlay_count = OVERLAY_SESSIONS
+    align_phase = Phase.CALIBRATION
+    overlay_key = None
+    overlay_view = None
 
-        keys = gui.pump_events()
+    while True:
+        if overlay:
+            if overlay_key != (current_view, overlay_count, align_phase):
+                overlay_key = (current_view, overlay_count, align_phase)
+                overlay_view = build_overlay(*overlay_key)
+            view = overlay_view
+        else:
+            view = views.get(current_view, current_mode)
+        if shown is not view:
+            if shown is not None:
+                shown.release()
+            shown = view
+            redraw = True
+
+        # Nothing on screen changes unless something happens, so only draw when it does.
+        if gui.exposed:
+            gui.exposed = False
+            view.on_screen = False
+            redraw = True
+        if redraw:
+            gui.present(view(gui, current_mode))
+
+        if not overlay and prefetched != (current_view, current_mode):
+            prefetched = (current_view, current_mode)
+            ahead = [current_view + direction * step for step in range(1, 4)]
+            behind = [current_view - direction]
+            views.prefetch(
+                [index for index in ahead + behind if 0 <= index < len(summaries)], current_mode)
+
+        if stats:
+            stats.tick(redraw)
+
+        keys, redraw = gui.wait_events(VIEWER_IDLE_TIMEOUT)
         if keys.count(pygame.K_RETURN):
             current_mode = (current_mode + 1) % mode_count
 
         elif keys.count(pygame.K_LEFT):
             current_view = max(current_view - 1, 0)
+            direction = -1
 
         elif keys.count(pygame.K_RIGHT):
-            current_view = min(current_view + 1, len(views) -1)
+            current_view = min(current_view + 1, len(summaries) -1)
+            direction = 1
+
+        elif keys.count(pygame.K_o):
+            overlay = not overlay
+
+        elif overlay and keys.count(pygame.K_a):
+            if align_phase == Phase.CALIBRATION:
+                align_phase = Phase.STEADY
+            else:
+                align_phase = Phase.CALIBRATION
+
+        elif overlay and keys.count(pygame.K_UP):
+            overlay_count = min(overlay_count + 1, MAX_OVERLAY_SESSIONS)
+
+        elif overlay and keys.count(pygame.K_DOWN):
+            overlay_count = max(overlay_count - 1, 2)